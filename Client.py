@@ -6,7 +6,7 @@ import numpy as np
 from multiprocessing import Process
 import time
 from args import args
-from pyanime4k import ac
+from upscaler import Anime4KUpscaler, UpscaleWorker
 import socket
 import warnings
 
@@ -28,23 +28,20 @@ class EasyAIV(Process):  #
             cam_width_scale = 1
             cam = pyvirtualcam.Camera(width=args.output_w * cam_scale * cam_width_scale,
                                       height=args.output_h * cam_scale,
-                                      fps=30,
+                                      fps=args.fps,
                                       backend=args.output_webcam,
                                       fmt=
                                       {'unitycapture': pyvirtualcam.PixelFormat.RGBA,
                                        'obs': pyvirtualcam.PixelFormat.RGB}[
                                           args.output_webcam])
             print(f'Using virtual camera: {cam.device}')
-        parameters = ac.Parameters()
-        # enable HDN for ACNet
-        parameters.HDN = True
+        upscale_worker = None
         if args.anime4k:
-            a = ac.AC(
-                managerList=ac.ManagerList([ac.OpenCLACNetManager(pID=0, dID=0)]),
-                type=ac.ProcessorType.OpenCL_ACNet,
-            )
-            a.set_arguments(parameters)
-            print("Anime4K Loaded")
+            # 超分在单独的线程里进行，和下一帧的接收、解码重叠
+            upscaler = Anime4KUpscaler()
+            upscale_worker = UpscaleWorker(upscaler)
+            upscale_worker.start()
+            print("Anime4K Loaded:", upscaler.backend)
         while True:
             try:
                 self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # 创建新的socket
@@ -73,21 +70,12 @@ class EasyAIV(Process):  #
                         # img_np = np.frombuffer(decompressed_data, dtype=np.uint8)
                         img_np = np.frombuffer(data, dtype=np.uint8)
                         result_image = cv2.imdecode(img_np, cv2.IMREAD_UNCHANGED)
-                        if args.anime4k:
-                            ################################
-
-                            alpha_channel = result_image[:, :, 3]
-                            alpha_channel = cv2.resize(alpha_channel, None, fx=2, fy=2)
-
-                            img1 = cv2.cvtColor(result_image, cv2.COLOR_RGBA2BGR)
-                            a.load_image_from_numpy(img1, input_type=ac.AC_INPUT_BGR)
-                            a.process()
-                            result_image_cam = a.save_image_to_numpy()
-                            result_image_cam = cv2.merge((result_image_cam, alpha_channel))
-                            result_image_cam = cv2.cvtColor(result_image_cam, cv2.COLOR_BGRA2RGBA)
-                            ##################################
-                            cam.send(result_image_cam)
-                            cam.sleep_until_next_frame()
+                        if upscale_worker is not None:
+                            # 取回的是上一帧的超分结果
+                            result_image_cam = upscale_worker.process(result_image)
+                            if result_image_cam is not None:
+                                cam.send(result_image_cam)
+                                cam.sleep_until_next_frame()
                         else:
                             cam.send(result_image)
                             cam.sleep_until_next_frame()
@@ -42,8 +42,22 @@ def calc_cur(start, end, period):
     return start + math.sin(period) * (end - start)
 
 
+def calc_period(t, start_time, end_time):
+    if end_time <= start_time:
+        return HALF_PI
+    return (t - start_time) / (end_time - start_time) * HALF_PI
+
+
+def find_segment(segments, time_index, t):
+    for segment in segments:
+        if segment[time_index][1] >= t:
+            return segment
+    return None
+
+
 class ActionAnimeV2:
-    def __init__(self):
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock  # 时间线使用的时钟，离线输出时按帧推进
         self.action_state = [False] * len(ActionState)  # 同时只能有1个为True，用作动作状态过渡
 
         self.eyebrow_vector_c = [0.0] * 12
@@ -56,6 +70,7 @@ class ActionAnimeV2:
         self.head_axial = deque()  # [[start, end], [start_time, end_time]]
         self.head_coronal = deque()  # [[start, end], [start_time, end_time]]
         self.head_sagittal = deque()  # [[start, end], [start_time, end_time]]
+        self.timeline_generation = 0  # 每次重置时间线+1，预渲染的帧据此判断是否作废
 
     def singing(self, beat_q, mouth_q):
         if beat_q is None or mouth_q is None:
@@ -258,42 +273,70 @@ class ActionAnimeV2:
             self.head_sagittal.append([[s_cur, s_cur], [t_cur, t_next]])
 
     def calc_cur_vector(self):
-        eyebrow_vector_c = [0.0] * 12
-        mouth_eye_vector_c = [0.0] * 27
-        pose_vector_c = [0.0] * 6
-
         self.deque_pop_outdated()
         self.check_deque()
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
+
+        eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c = self.vector_at(
+            cur_time, self.eyelid[0], self.eyeball[0], self.mouth[0],
+            self.head_axial[0], self.head_coronal[0], self.head_sagittal[0])
+
+        self.eyebrow_vector_c = eyebrow_vector_c
+        self.mouth_eye_vector_c = mouth_eye_vector_c
+        self.pose_vector_c = pose_vector_c
+        return eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c
 
-        period = (cur_time - self.eyelid[0][2][0]) / (self.eyelid[0][2][1] - self.eyelid[0][2][0]) * HALF_PI
-        mouth_eye_vector_c[3] = calc_cur(self.eyelid[0][0][0], self.eyelid[0][0][1], period)
-        mouth_eye_vector_c[2] = calc_cur(self.eyelid[0][1][0], self.eyelid[0][1][1], period)
+    def sample_vector(self, t):
+        # 按已经排好的时间线取t时刻的参数，不修改deque；t超出已知时间线时返回None
+        segments = [find_segment(self.eyelid, 2, t), find_segment(self.eyeball, 2, t),
+                    find_segment(self.mouth, 1, t), find_segment(self.head_axial, 1, t),
+                    find_segment(self.head_coronal, 1, t), find_segment(self.head_sagittal, 1, t)]
+        if any(segment is None for segment in segments):
+            return None
+        return self.vector_at(t, *segments)
+
+    def horizon(self):
+        # 所有时间线都已知的最晚时刻
+        ends = [self.eyelid[-1][2][1] if self.eyelid else None,
+                self.eyeball[-1][2][1] if self.eyeball else None,
+                self.mouth[-1][1][1] if self.mouth else None,
+                self.head_axial[-1][1][1] if self.head_axial else None,
+                self.head_coronal[-1][1][1] if self.head_coronal else None,
+                self.head_sagittal[-1][1][1] if self.head_sagittal else None]
+        if any(end is None for end in ends):
+            return None
+        return min(ends)
+
+    @staticmethod
+    def vector_at(t, eyelid, eyeball, mouth, head_axial, head_coronal, head_sagittal):
+        eyebrow_vector_c = [0.0] * 12
+        mouth_eye_vector_c = [0.0] * 27
+        pose_vector_c = [0.0] * 6
 
-        period = (cur_time - self.eyeball[0][2][0]) / (self.eyeball[0][2][1] - self.eyeball[0][2][0]) * HALF_PI
-        mouth_eye_vector_c[26] = calc_cur(self.eyeball[0][0][0], self.eyeball[0][0][1], period)
-        mouth_eye_vector_c[25] = calc_cur(self.eyeball[0][1][0], self.eyeball[0][1][1], period)
+        period = calc_period(t, eyelid[2][0], eyelid[2][1])
+        mouth_eye_vector_c[3] = calc_cur(eyelid[0][0], eyelid[0][1], period)
+        mouth_eye_vector_c[2] = calc_cur(eyelid[1][0], eyelid[1][1], period)
 
-        period = (cur_time - self.mouth[0][1][0]) / (self.mouth[0][1][1] - self.mouth[0][1][0]) * HALF_PI
-        mouth_eye_vector_c[self.mouth[0][2]] = calc_cur(self.mouth[0][0][0], self.mouth[0][0][1], period)
+        period = calc_period(t, eyeball[2][0], eyeball[2][1])
+        mouth_eye_vector_c[26] = calc_cur(eyeball[0][0], eyeball[0][1], period)
+        mouth_eye_vector_c[25] = calc_cur(eyeball[1][0], eyeball[1][1], period)
 
-        period = (cur_time - self.head_axial[0][1][0]) / (self.head_axial[0][1][1] - self.head_axial[0][1][0]) * HALF_PI
-        pose_vector_c[1] = calc_cur(self.head_axial[0][0][0], self.head_axial[0][0][1], period)
+        period = calc_period(t, mouth[1][0], mouth[1][1])
+        mouth_eye_vector_c[mouth[2]] = calc_cur(mouth[0][0], mouth[0][1], period)
 
-        period = (cur_time - self.head_coronal[0][1][0]) / (self.head_coronal[0][1][1] - self.head_coronal[0][1][0]) * HALF_PI
-        pose_vector_c[2] = calc_cur(self.head_coronal[0][0][0], self.head_coronal[0][0][1], period)
+        period = calc_period(t, head_axial[1][0], head_axial[1][1])
+        pose_vector_c[1] = calc_cur(head_axial[0][0], head_axial[0][1], period)
 
-        period = (cur_time - self.head_sagittal[0][1][0]) / (self.head_sagittal[0][1][1] - self.head_sagittal[0][1][0]) * HALF_PI
-        pose_vector_c[0] = calc_cur(self.head_sagittal[0][0][0], self.head_sagittal[0][0][1], period)
+        period = calc_period(t, head_coronal[1][0], head_coronal[1][1])
+        pose_vector_c[2] = calc_cur(head_coronal[0][0], head_coronal[0][1], period)
 
-        self.eyebrow_vector_c = eyebrow_vector_c
-        self.mouth_eye_vector_c = mouth_eye_vector_c
-        self.pose_vector_c = pose_vector_c
+        period = calc_period(t, head_sagittal[1][0], head_sagittal[1][1])
+        pose_vector_c[0] = calc_cur(head_sagittal[0][0], head_sagittal[0][1], period)
         return eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c
 
     def check_deque(self):
         # 检查depue是否为空，若为空则加入归正动作
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
         return_time = cur_time + 0.3  # 回正时长
         if len(self.eyelid) == 0:
             self.eyelid.append([[self.mouth_eye_vector_c[3], 0], [self.mouth_eye_vector_c[2], 0], [cur_time, return_time]])
@@ -314,37 +357,37 @@ class ActionAnimeV2:
             self.head_sagittal.append([[self.pose_vector_c[0], 0], [cur_time, return_time]])
 
     def deque_pop_outdated(self):
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
         while len(self.eyelid) > 0:
             if self.eyelid[0][2][1] < cur_time:
                 self.eyelid.popleft()
             else:
                 break
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
         while len(self.eyeball) > 0:
             if self.eyeball[0][2][1] < cur_time:
                 self.eyeball.popleft()
             else:
                 break
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
         while len(self.mouth) > 0:
             if self.mouth[0][1][1] < cur_time:
                 self.mouth.popleft()
             else:
                 break
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
         while len(self.head_axial) > 0:
             if self.head_axial[0][1][1] < cur_time:
                 self.head_axial.popleft()
             else:
                 break
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
         while len(self.head_coronal) > 0:
             if self.head_coronal[0][1][1] < cur_time:
                 self.head_coronal.popleft()
             else:
                 break
-        cur_time = time.perf_counter()
+        cur_time = self.clock()
         while len(self.head_sagittal) > 0:
             if self.head_sagittal[0][1][1] < cur_time:
                 self.head_sagittal.popleft()
@@ -352,6 +395,7 @@ class ActionAnimeV2:
                 break
 
     def reset_deque(self):
+        self.timeline_generation += 1
         self.eyelid = deque()
         self.eyeball = deque()
         self.mouth = deque()
@@ -19,28 +19,44 @@ parser.add_argument('--extend_movement', type=float)
 parser.add_argument('--input', type=str, default='cam')
 parser.add_argument('--character', type=str, default='喵酱皮套V1')
 parser.add_argument('--output_dir', type=str)
+parser.add_argument('--sink', type=str, choices=['cam', 'images', 'ffmpeg', 'null'])  # 画面输出方式，不传按--output_webcam/--output_dir选择
 parser.add_argument('--output_webcam', type=str, default='unitycapture')
 parser.add_argument('--output_size', type=str, default='512x512')
 parser.add_argument('--model', type=str, default='standard_half')
 parser.add_argument('--debug_input', action='store_true')
 parser.add_argument('--perf', type=str)
+parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnxruntime'])  # onnxruntime用于只有CPU的机器
+parser.add_argument('--ort_threads', type=int, default=0)  # onnxruntime的intra-op线程数，0为自动
+parser.add_argument('--optimize', action='store_true')  # 加载时做channels_last、归一化折叠等推理优化
+parser.add_argument('--torchscript', action='store_true')  # 追踪模型并缓存到data/models/<model>/下，之后直接加载
+parser.add_argument('--roi', action='store_true')  # 姿势不变时只重算脸部区域（眨眼、口型帧）
+parser.add_argument('--render_scale', type=float, default=1.0, choices=[1.0, 0.5, 0.25])  # 旋转和编辑网络的渲染比例
 parser.add_argument('--anime4k', action='store_true', default=False)
 parser.add_argument('--alpha_split', action='store_true')
 parser.add_argument('--bongo', action='store_true')
+parser.add_argument('--gpu_warp', action='store_true')  # 在模型进程的显存里做输出画面的平移旋转缩放
 parser.add_argument('--cache', type=str, default='256mb')  # 256mb
 parser.add_argument('--gpu_cache', type=str, default='256mb')  # 256mb
+parser.add_argument('--disk_cache', type=str)  # 渲染结果的磁盘缓存目录，不传则关闭
+parser.add_argument('--disk_cache_size', type=str, default='2gb')  # 每个角色的磁盘缓存上限
 parser.add_argument('--simplify', type=int, default=1)
+parser.add_argument('--cache_policy', type=str, default='lru', choices=['lru', 'lfu', '2q'])  # 缓存淘汰策略
+parser.add_argument('--cache_tolerance', type=int, default=0)  # 缓存近似命中允许的量化误差（步数），0为精确匹配
 parser.add_argument('--port', type=int, default=7888)
 parser.add_argument('--sleep', type=int, default=-1)
+parser.add_argument('--fps', type=int, default=30)
+parser.add_argument('--lookahead', type=int, default=0)  # 提前渲染的帧数，0为关闭
+parser.add_argument('--interpolate', type=str, default='none', choices=['none', 'blend', 'flow'])  # 模型帧之间补帧
 args = parser.parse_args()
 args.output_w = int(args.output_size.split('x')[0])
 args.output_h = int(args.output_size.split('x')[1])
+args.half = args.model.endswith('half') and args.backend == 'torch'  # onnxruntime统一用float32
 if args.cache is not None:
-    args.max_cache_len = int(convert_to_byte(args.cache) / 262144 / 4)
+    args.max_cache_bytes = int(convert_to_byte(args.cache))
 else:
-    args.max_cache_len = 0
+    args.max_cache_bytes = 0
 if args.gpu_cache is not None:
-    args.max_gpu_cache_len = int(convert_to_byte(args.gpu_cache) / 589824 / 4)
+    args.max_gpu_cache_bytes = int(convert_to_byte(args.gpu_cache))
 else:
-    args.max_gpu_cache_len = 0
+    args.max_gpu_cache_bytes = 0
 if args.output_webcam is None and args.output_dir is None: args.debug = True
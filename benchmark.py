@@ -0,0 +1,260 @@
+"""
+性能测试脚本，例如
+python benchmark.py postprocess --device cuda:0
+python benchmark.py int8 --base standard
+python benchmark.py optimize --model standard_half
+python benchmark.py render_scale --model standard_half
+python benchmark.py alpha_split --size 1920x1080
+没有被子命令用到的参数会原样交给args.py（比如--model standard_half）
+"""
+import argparse
+import math
+import sys
+import time
+
+import torch
+
+
+def timeit(fn, iterations, device):
+    for _ in range(5):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    tic = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - tic) * 1000 / iterations
+
+
+def reference_postprocess(output_image):
+    # 原来main.py中逐步转换的写法
+    from tha3.util import torch_linear_to_srgb
+    image = (output_image.float() + 1.0) / 2.0
+    image = torch.cat([torch_linear_to_srgb(image[0:3, :, :]), image[3:4, :, :]], dim=0)
+    c, h, w = image.shape
+    image = 255.0 * torch.transpose(image.reshape(c, h * w), 0, 1).reshape(h, w, c)
+    return image.byte()
+
+
+def bench_postprocess(options):
+    from utils import linear_rgba2srgb_uint8
+    device = torch.device(options.device)
+    dtype = torch.half if options.half else torch.float
+    output_image = (torch.rand(4, 512, 512, device=device) * 2 - 1).to(dtype)
+    reference = reference_postprocess(output_image)
+    fused = linear_rgba2srgb_uint8(output_image)
+    diff = (reference.int() - fused.int()).abs()
+    print(f"postprocess 512x512 {dtype} on {device}")
+    print(" - reference  %.3f ms" % timeit(lambda: reference_postprocess(output_image), options.iterations, device))
+    print(" - lut        %.3f ms" % timeit(lambda: linear_rgba2srgb_uint8(output_image), options.iterations, device))
+    print(" - max diff %d, %.2f%% values differ" % (diff.max().item(), (diff > 0).float().mean().item() * 100))
+
+
+def psnr(a, b):
+    mse = ((a.float() - b.float()) ** 2).mean().item()
+    return float('inf') if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def reference_alpha_split(image):
+    # 原来main.py中--alpha_split的写法
+    import cv2
+    alpha_image = cv2.merge([image[:, :, 3], image[:, :, 3], image[:, :, 3]])
+    alpha_image = cv2.cvtColor(alpha_image, cv2.COLOR_RGB2RGBA)
+    return cv2.hconcat([image, alpha_image])
+
+
+def bench_alpha_split(options):
+    import numpy as np
+    from compositor import AlphaSplitLayout
+    device = torch.device('cpu')
+    layout = AlphaSplitLayout()
+    for size in options.size:
+        w, h = [int(v) for v in size.split('x')]
+        image = np.random.default_rng(0).integers(0, 256, (h, w, 4), dtype=np.uint8)
+        assert np.array_equal(reference_alpha_split(image), layout.compose(image))
+        reference_ms = timeit(lambda: reference_alpha_split(image), options.iterations, device)
+        layout_ms = timeit(lambda: layout.compose(image), options.iterations, device)
+        print("alpha_split %dx%d -> %dx%d" % (w, h, 2 * w, h))
+        print(" - merge/cvtColor/hconcat  %.3f ms" % reference_ms)
+        print(" - preallocated            %.3f ms (%.2fx)" % (layout_ms, reference_ms / layout_ms))
+
+
+def load_sample_image(path, dtype):
+    # 和main.py的prepare_input_img一样，缩放到512宽后取顶部512x512
+    from PIL import Image
+    from utils import preprocessing_image
+    img = Image.open(path).convert('RGBA')
+    img = img.resize((512, int(img.size[1] * 512 / img.size[0])))
+    image = torch.from_numpy(preprocessing_image(img.crop((0, 0, 512, 512)))).to(dtype) * 2.0 - 1
+    return image.unsqueeze(0)
+
+
+def sample_poses(count, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    eyebrow = torch.rand(count, 12, generator=generator)
+    mouth_eye = torch.rand(count, 27, generator=generator)
+    pose = (torch.rand(count, 6, generator=generator) * 2 - 1) * 0.6
+    return eyebrow, mouth_eye, pose
+
+
+def build_model(variant):
+    from args import args
+    import models
+    args.model = variant
+    args.half = False
+    return models.TalkingAnime3().eval()
+
+
+@torch.no_grad()
+def calibrate_int8(base, images, poses):
+    import os
+    from args import args
+    from tha3.nn.quantization import prepare_int8, convert_int8
+    model = build_model(f'{base}_float')
+    names = [name for name in ['eyebrow_morphing_combiner', 'face_morpher', 'two_algo_face_body_rotator',
+                               'editor'] if hasattr(model, name)]
+    for name in names:
+        prepare_int8(getattr(model, name))
+    eyebrow, mouth_eye, pose = poses
+    for image in images:
+        for i in range(pose.shape[0]):
+            model.forward_batch(image, mouth_eye[i:i + 1], pose[i:i + 1], eyebrow[i:i + 1])
+    if args.eyebrow:
+        # 分解器每张图只跑一次，单独用样例图校准
+        names.append('eyebrow_decomposer')
+        prepare_int8(model.eyebrow_decomposer)
+        for image in images:
+            model.eyebrow_decomposer(image[:, :, 64:192, 64 + 128:192 + 128])
+    os.makedirs(f'data/models/{base}_int8', exist_ok=True)
+    for name in names:
+        module = convert_int8(getattr(model, name))
+        torch.save(module.state_dict(), f'data/models/{base}_int8/{name}.pt')
+        print(f"Saved data/models/{base}_int8/{name}.pt")
+
+
+@torch.no_grad()
+def bench_int8(options):
+    import glob
+    import os
+    from utils import linear_rgba2srgb_uint8
+    torch.backends.quantized.engine = options.engine
+    paths = sorted(glob.glob('data/images/*.png'))
+    images = [load_sample_image(path, torch.float) for path in paths]
+    poses = sample_poses(options.poses)
+    if options.calibrate or not os.path.exists(f'data/models/{options.base}_int8/editor.pt'):
+        calibrate_int8(options.base, images, sample_poses(options.poses, seed=1))
+    eyebrow, mouth_eye, pose = poses
+    outputs = {}
+    for variant in [f'{options.base}_float', f'{options.base}_int8']:
+        model = build_model(variant)
+        frames = []
+        tic = time.perf_counter()
+        for image in images:
+            for i in range(pose.shape[0]):
+                output = model.forward_batch(image, mouth_eye[i:i + 1], pose[i:i + 1], eyebrow[i:i + 1])
+                frames.append(linear_rgba2srgb_uint8(output[0]))
+        outputs[variant] = (frames, (time.perf_counter() - tic) * 1000 / len(frames))
+    float_frames, float_ms = outputs[f'{options.base}_float']
+    int8_frames, int8_ms = outputs[f'{options.base}_int8']
+    values = [psnr(a, b) for a, b in zip(float_frames, int8_frames)]
+    print(f"{len(paths)} images x {options.poses} poses on CPU, {torch.get_num_threads()} threads")
+    print(" - %s  %.1f ms/frame" % (f'{options.base}_float', float_ms))
+    print(" - %s   %.1f ms/frame (%.2fx)" % (f'{options.base}_int8', int8_ms, float_ms / int8_ms))
+    print(" - PSNR vs float: mean %.2f dB, min %.2f dB" % (sum(values) / len(values), min(values)))
+
+
+@torch.no_grad()
+def bench_optimize(options):
+    from args import args
+    from models import NETWORKS, load_eager_network
+    from tha3.nn.inference_optimization import max_output_difference
+    device = torch.device(options.device)
+    dtype = torch.half if args.model.endswith('half') else torch.float
+    failed = []
+    print(f"{args.model} on {device}")
+    for name, (_, input_shapes) in NETWORKS.items():
+        module = load_eager_network(args.model, name).to(device).eval()
+        optimized = load_eager_network(args.model, name, optimize=True).to(device).eval()
+        inputs = tuple((torch.rand(shape, device=device) * 2 - 1).to(dtype) for shape in input_shapes)
+        error = max_output_difference(module, optimized, inputs)
+        plain_ms = timeit(lambda: module(*inputs), options.iterations, device)
+        optimized_ms = timeit(lambda: optimized(*inputs), options.iterations, device)
+        print(" - %-28s %.2f ms -> %.2f ms, max abs error %.2e" % (name, plain_ms, optimized_ms, error))
+        if error > options.tolerance:
+            failed.append(name)
+    if len(failed) > 0:
+        print("Outputs changed beyond tolerance:", ", ".join(failed))
+        sys.exit(1)
+
+
+@torch.no_grad()
+def bench_render_scale(options):
+    import glob
+    from args import args
+    import models
+    from utils import linear_rgba2srgb_uint8
+    device = torch.device(options.device)
+    dtype = torch.half if args.half else torch.float
+    paths = sorted(glob.glob('data/images/*.png'))
+    images = [load_sample_image(path, dtype).to(device) for path in paths]
+    eyebrow, mouth_eye, pose = [t.to(device, dtype) for t in sample_poses(options.poses)]
+    print(f"{args.model}, {len(paths)} images x {options.poses} poses on {device}")
+    reference = None
+    for scale in options.scales:
+        args.render_scale = scale
+        model = models.TalkingAnime3(device).to(device).eval()
+
+        def render_all():
+            return [linear_rgba2srgb_uint8(model.forward_batch(image, mouth_eye[i:i + 1], pose[i:i + 1],
+                                                               eyebrow[i:i + 1])[0])
+                    for image in images for i in range(pose.shape[0])]
+
+        frames = render_all()
+        ms = timeit(render_all, options.iterations, device) / len(frames)
+        if reference is None:
+            reference = frames
+        values = [psnr(a, b) for a, b in zip(reference, frames)]
+        print(" - scale %.2f (%dx%d)  %.1f ms/frame, %.1f fps, PSNR vs scale %.2f: mean %.2f dB, min %.2f dB" % (
+            scale, model.render_size, model.render_size, ms, 1000 / ms, options.scales[0],
+            sum(values) / len(values), min(values)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    postprocess_parser = subparsers.add_parser('postprocess', help='linear->srgb output conversion')
+    postprocess_parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    postprocess_parser.add_argument('--half', action='store_true')
+    postprocess_parser.add_argument('--iterations', type=int, default=200)
+    postprocess_parser.set_defaults(func=bench_postprocess)
+    int8_parser = subparsers.add_parser('int8', help='int8 vs float quality/latency on data/images (CPU)')
+    int8_parser.add_argument('--base', type=str, default='standard', choices=['standard', 'separable'])
+    int8_parser.add_argument('--poses', type=int, default=8)
+    int8_parser.add_argument('--calibrate', action='store_true', help='recalibrate even if int8 weights exist')
+    int8_parser.add_argument('--engine', type=str, default=torch.backends.quantized.engine)
+    int8_parser.set_defaults(func=bench_int8)
+    optimize_parser = subparsers.add_parser('optimize', help='check --optimize against the plain networks')
+    optimize_parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    optimize_parser.add_argument('--iterations', type=int, default=20)
+    optimize_parser.add_argument('--tolerance', type=float, default=1e-2)
+    optimize_parser.set_defaults(func=bench_optimize)
+    render_scale_parser = subparsers.add_parser('render_scale', help='fps vs quality of --render_scale on data/images')
+    render_scale_parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    render_scale_parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5, 0.25])
+    render_scale_parser.add_argument('--poses', type=int, default=8)
+    render_scale_parser.add_argument('--iterations', type=int, default=3)
+    render_scale_parser.set_defaults(func=bench_render_scale)
+    alpha_split_parser = subparsers.add_parser('alpha_split', help='--alpha_split output layout')
+    alpha_split_parser.add_argument('--size', type=str, nargs='+', default=['512x512', '1920x1080'])
+    alpha_split_parser.add_argument('--iterations', type=int, default=200)
+    alpha_split_parser.set_defaults(func=bench_alpha_split)
+    options, rest = parser.parse_known_args()
+    # args.py在导入时解析命令行，只把剩下的参数留给它
+    sys.argv = sys.argv[:1] + rest
+    options.func(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+import hashlib
+import os
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+
+def image_hash(image):
+    """
+    content hash of a character image
+    Args:
+        image (tensor): input image on any device
+    Returns:
+        hex string
+    """
+    return hashlib.sha1(image.detach().cpu().numpy().tobytes()).hexdigest()[:16]
+
+
+class DiskFrameCache:
+    """
+    Append-only pack file of rendered frames, one file per (image hash, model variant).
+    Record layout: [key length: u16][key][frame]. The index is rebuilt by scanning the pack
+    on open; a truncated record left by a crash is cut off.
+    """
+    KEY_HEADER = struct.Struct('<H')
+
+    def __init__(self, directory, variant, frame_shape, max_bytes):
+        self.directory = directory
+        self.variant = variant
+        self.frame_shape = tuple(frame_shape)
+        self.frame_bytes = int(np.prod(self.frame_shape))
+        self.max_bytes = max_bytes
+        self.file = None
+        self.file_size = 0
+        self.index = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, image_hash):
+        self.close()
+        path = os.path.join(self.directory, f"{image_hash}_{self.variant}.pack")
+        self.file = open(path, 'a+b')
+        self.index = {}
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        offset = 0
+        self.file.seek(0)
+        while offset + self.KEY_HEADER.size <= size:
+            key_len, = self.KEY_HEADER.unpack(self.file.read(self.KEY_HEADER.size))
+            frame_offset = offset + self.KEY_HEADER.size + key_len
+            if frame_offset + self.frame_bytes > size:
+                break
+            key = self.file.read(key_len)
+            self.index[key] = frame_offset
+            offset = frame_offset + self.frame_bytes
+            self.file.seek(offset)
+        if offset != size:
+            self.file.truncate(offset)
+        self.file_size = offset
+        print(f"Disk cache opened: {path} ({len(self.index)} frames)")
+
+    def get(self, key):
+        offset = self.index.get(key)
+        if offset is None:
+            return None
+        self.file.seek(offset)
+        return np.frombuffer(self.file.read(self.frame_bytes), dtype=np.uint8).reshape(self.frame_shape)
+
+    def put(self, key, frame):
+        if key in self.index or self.file_size + self.frame_bytes > self.max_bytes:
+            return
+        # a+b模式下写入总是追加到文件末尾
+        self.file.write(self.KEY_HEADER.pack(len(key)))
+        self.file.write(key)
+        self.file.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self.index[key] = self.file_size + self.KEY_HEADER.size + len(key)
+        self.file_size = self.index[key] + self.frame_bytes
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PoseKeyIndex:
+    """
+    Nearest-neighbour lookup over packed pose keys. Distance is the largest per-parameter
+    difference in quantization steps, so one tolerance works for every simplify level.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.keys = None
+        self.used = np.zeros(capacity, dtype=bool)
+        self.row_keys = [None] * capacity
+        self.rows = {}
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def add(self, key, key_bytes):
+        if key_bytes in self.rows:
+            return
+        if self.keys is None:
+            self.keys = np.zeros((self.capacity, len(key)), dtype=np.int32)
+        if len(self.free) == 0:
+            self.keys = np.concatenate([self.keys, np.zeros_like(self.keys)])
+            self.used = np.concatenate([self.used, np.zeros_like(self.used)])
+            self.row_keys.extend([None] * self.capacity)
+            self.free = list(range(2 * self.capacity - 1, self.capacity - 1, -1))
+            self.capacity *= 2
+        row = self.free.pop()
+        self.keys[row] = key
+        self.used[row] = True
+        self.row_keys[row] = key_bytes
+        self.rows[key_bytes] = row
+
+    def remove(self, key_bytes):
+        row = self.rows.pop(key_bytes, None)
+        if row is not None:
+            self.used[row] = False
+            self.row_keys[row] = None
+            self.free.append(row)
+
+    def nearest(self, key, tolerance):
+        if len(self.rows) == 0:
+            return None
+        distance = np.abs(self.keys - key).max(axis=1)
+        distance[~self.used] = np.iinfo(np.int32).max
+        row = int(distance.argmin())
+        if distance[row] > tolerance:
+            return None
+        return self.row_keys[row]
+
+    def clear(self):
+        self.__init__(self.capacity)
+
+
+class LRUPolicy:
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def insert(self, key):
+        self.keys[key] = None
+
+    def hit(self, key):
+        self.keys.move_to_end(key)
+
+    def victim(self):
+        return next(iter(self.keys))
+
+    def remove(self, key):
+        del self.keys[key]
+
+    def clear(self):
+        self.keys = OrderedDict()
+
+
+class LFUPolicy:
+    """
+    Evict the least frequently used key, oldest first among equal counts. O(1) per operation
+    with one insertion-ordered bucket per frequency.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def insert(self, key):
+        self.freq[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_freq = 1
+
+    def hit(self, key):
+        freq = self.freq[key]
+        self.unlink(key, freq)
+        self.freq[key] = freq + 1
+        self.buckets.setdefault(freq + 1, OrderedDict())[key] = None
+
+    def victim(self):
+        while self.min_freq not in self.buckets:
+            self.min_freq += 1
+        return next(iter(self.buckets[self.min_freq]))
+
+    def remove(self, key):
+        self.unlink(key, self.freq.pop(key))
+
+    def unlink(self, key, freq):
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = freq + 1
+
+    def clear(self):
+        self.freq = {}
+        self.buckets = {}
+        self.min_freq = 1
+
+
+class TwoQueuePolicy:
+    """
+    Simplified 2Q. New keys enter a FIFO probation queue (a1in). Keys evicted from it are
+    remembered in a ghost queue (a1out), and only a key seen again while in the ghost queue
+    is promoted to the protected LRU queue (am). One-off frames such as song mouth shapes
+    pass through probation without pushing out recurring idle/blink frames.
+    """
+
+    def __init__(self, kin=0.25, kout=0.5):
+        self.kin = kin
+        self.kout = kout
+        self.clear()
+
+    def insert(self, key):
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = None
+        else:
+            self.a1in[key] = None
+
+    def hit(self, key):
+        if key in self.am:
+            self.am.move_to_end(key)
+
+    def victim(self):
+        total = len(self.a1in) + len(self.am)
+        if len(self.am) == 0 or len(self.a1in) > max(1, int(total * self.kin)):
+            return next(iter(self.a1in))
+        return next(iter(self.am))
+
+    def remove(self, key):
+        if key in self.a1in:
+            del self.a1in[key]
+            # 只记住key，不保留帧
+            self.a1out[key] = None
+            while len(self.a1out) > max(16, int((len(self.a1in) + len(self.am)) * self.kout)):
+                self.a1out.popitem(last=False)
+        else:
+            del self.am[key]
+
+    def clear(self):
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+
+
+CACHE_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    '2q': TwoQueuePolicy,
+}
+
+
+def entry_bytes(value):
+    # numpy帧用nbytes，torch张量按实际元素大小计算（half和float不一样）
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return value.element_size() * value.nelement()
+
+
+class FrameCache:
+    """
+    Frame cache keyed by packed quantized pose keys (int16 numpy arrays), bounded by the
+    real byte size of the cached frames/tensors rather than an entry count. Eviction order
+    comes from one of CACHE_POLICIES.
+    With tolerance > 0 an exact miss falls back to the nearest cached pose whose every
+    parameter is within `tolerance` quantization steps.
+    """
+
+    def __init__(self, max_bytes, tolerance=0, policy='lru'):
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.policy_name = policy
+        self.policy = CACHE_POLICIES[policy]()
+        self.entries = {}
+        self.sizes = {}
+        self.bytes = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self.index = PoseKeyIndex() if tolerance > 0 else None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        key_bytes = key.tobytes()
+        value = self.entries.get(key_bytes)
+        if value is None and self.index is not None:
+            nearest = self.index.nearest(key, self.tolerance)
+            if nearest is not None:
+                key_bytes = nearest
+                value = self.entries[nearest]
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.policy.hit(key_bytes)
+        return value
+
+    def put(self, key, value):
+        size = entry_bytes(value)
+        if size > self.max_bytes:
+            return
+        key_bytes = key.tobytes()
+        if key_bytes in self.entries:
+            self.bytes -= self.sizes[key_bytes]
+            self.policy.hit(key_bytes)
+        else:
+            self.policy.insert(key_bytes)
+            if self.index is not None:
+                self.index.add(key, key_bytes)
+        self.entries[key_bytes] = value
+        self.sizes[key_bytes] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            evicted = self.policy.victim()
+            self.policy.remove(evicted)
+            del self.entries[evicted]
+            self.bytes -= self.sizes.pop(evicted)
+            self.evictions += 1
+            if self.index is not None:
+                self.index.remove(evicted)
+
+    def clear(self):
+        self.entries = {}
+        self.sizes = {}
+        self.bytes = 0
+        self.policy.clear()
+        if self.index is not None:
+            self.index.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'policy': self.policy_name, 'bytes': self.bytes, 'entries': len(self.entries),
+                'evictions': self.evictions, 'hit_ratio': self.hits / lookups if lookups > 0 else 0.0}
@@ -0,0 +1,97 @@
+import math
+
+import cv2
+import numpy as np
+
+from args import args
+
+
+def output_matrix(position_vector=(0, 0, 0, 1), image_width=512):
+    """
+    Affine matrix placing the model frame on the --output_size canvas, from the character
+    position and --extend_movement/--bongo.
+    """
+    k_scale = 1
+    rotate_angle = 0
+    dx = 0
+    dy = 0
+    if args.extend_movement:
+        k_scale = position_vector[2] * math.sqrt(args.extend_movement) + 1
+        rotate_angle = -position_vector[0] * 10 * args.extend_movement
+        dx = position_vector[0] * 400 * k_scale * args.extend_movement
+        dy = -position_vector[1] * 600 * k_scale * args.extend_movement
+    if args.bongo:
+        rotate_angle -= 5
+    rm = cv2.getRotationMatrix2D((image_width / 2, image_width / 2), rotate_angle, k_scale)
+    rm[0, 2] += dx + args.output_w / 2 - image_width / 2
+    rm[1, 2] += dy + args.output_h / 2 - image_width / 2
+    return rm
+
+
+class Compositor:
+    """
+    Places the 512x512 model frame on the output canvas with an affine matrix.
+    The matrix is classified per frame:
+     - identity with matching sizes: the frame is returned as is
+     - integer translation: the overlapping rows/cols are copied into a preallocated canvas
+     - anything else: cv2.warpAffine into a preallocated buffer
+    Returned arrays are reused by the next call.
+    """
+
+    def __init__(self, output_w, output_h):
+        self.output_w = output_w
+        self.output_h = output_h
+        self.canvas = None
+        self.canvas_offset = None
+        self.warped = None
+
+    def compose(self, image, matrix):
+        """
+        Args:
+            image (ndarray): HWC uint8 frame, not modified
+            matrix (ndarray): 2x3 affine matrix from image to output coordinates
+        """
+        if matrix[0, 0] == 1 and matrix[0, 1] == 0 and matrix[1, 0] == 0 and matrix[1, 1] == 1:
+            dx, dy = round(matrix[0, 2]), round(matrix[1, 2])
+            if abs(matrix[0, 2] - dx) < 1e-6 and abs(matrix[1, 2] - dy) < 1e-6:
+                if dx == 0 and dy == 0 and image.shape[:2] == (self.output_h, self.output_w):
+                    return image
+                return self.translate(image, int(dx), int(dy))
+        if self.warped is None or self.warped.shape[2:] != image.shape[2:]:
+            self.warped = np.empty((self.output_h, self.output_w) + image.shape[2:], dtype=image.dtype)
+        return cv2.warpAffine(image, matrix, (self.output_w, self.output_h), dst=self.warped)
+
+    def translate(self, image, dx, dy):
+        if self.canvas is None or self.canvas.shape[2:] != image.shape[2:]:
+            self.canvas = np.zeros((self.output_h, self.output_w) + image.shape[2:], dtype=image.dtype)
+            self.canvas_offset = None
+        h, w = image.shape[:2]
+        # 偏移不变时画布边缘一直是空的，只需覆盖角色所在区域
+        if self.canvas_offset != (dx, dy):
+            self.canvas.fill(0)
+            self.canvas_offset = (dx, dy)
+        top, left = max(0, dy), max(0, dx)
+        bottom, right = min(self.output_h, dy + h), min(self.output_w, dx + w)
+        if top < bottom and left < right:
+            self.canvas[top:bottom, left:right] = image[top - dy:bottom - dy, left - dx:right - dx]
+        return self.canvas
+
+
+class AlphaSplitLayout:
+    """
+    Side-by-side color|alpha frame for --alpha_split, written into one preallocated
+    double-width buffer: the left half is the frame, the right half repeats its alpha in
+    RGB with an opaque alpha channel. The returned buffer is reused by the next call.
+    """
+
+    def __init__(self):
+        self.buffer = None
+
+    def compose(self, image):
+        h, w, c = image.shape
+        if self.buffer is None or self.buffer.shape != (h, 2 * w, c):
+            self.buffer = np.empty((h, 2 * w, c), dtype=image.dtype)
+            self.buffer[:, w:, 3] = 255  # 右半边的alpha固定不透明，只需写一次
+        self.buffer[:, :w] = image
+        self.buffer[:, w:, 0:3] = image[:, :, 3:4]
+        return self.buffer
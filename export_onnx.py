@@ -0,0 +1,55 @@
+"""
+把tha3的各个网络导出为ONNX，供 --backend onnxruntime 使用，例如
+python export_onnx.py --model standard_float
+python export_onnx.py --all
+导出后会用随机输入对比onnxruntime和torch的输出
+"""
+import argparse
+import sys
+
+import torch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='standard_float')
+parser.add_argument('--all', action='store_true')
+parser.add_argument('--opset', type=int, default=16)  # grid_sample需要16以上
+parser.add_argument('--tolerance', type=float, default=1e-3)
+options = parser.parse_args()
+# models会导入args.py，它在导入时解析命令行
+sys.argv = sys.argv[:1]
+
+from models import MODEL_MODES, NETWORKS, load_eager_network
+from onnx_backend import OnnxModule
+
+
+@torch.no_grad()
+def export_network(variant, name):
+    input_shapes = NETWORKS[name][1]
+    # half模型在CPU上没法跑，统一导出float32
+    module = load_eager_network(variant, name).float().eval()
+    inputs = tuple(torch.rand(shape) * 2 - 1 for shape in input_shapes)
+    path = f'data/models/{variant}/{name}.onnx'
+    torch.onnx.export(module, inputs, path, opset_version=options.opset,
+                      input_names=[f'input{i}' for i in range(len(inputs))])
+    expected = module(*inputs)
+    actual = OnnxModule(path)(*inputs)
+    error = max((e - a).abs().max().item() for e, a in zip(expected, actual))
+    print(f"{path}: max abs error {error:.2e}")
+    return error <= options.tolerance
+
+
+def main():
+    # int8变体是CPU上的量化模块，不能导出ONNX
+    variants = [v for v in MODEL_MODES if not v.endswith('_int8')] if options.all else [options.model]
+    failed = []
+    for variant in variants:
+        for name in NETWORKS:
+            if not export_network(variant, name):
+                failed.append(f'{variant}/{name}')
+    if len(failed) > 0:
+        print("Numerical check failed:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
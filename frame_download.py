@@ -0,0 +1,122 @@
+import torch
+
+
+class FrameDownloader:
+    """
+    Double-buffered device-to-host copy of rendered frames.
+    submit() queues a non_blocking copy into a preallocated pinned host buffer and records a
+    CUDA event; collect() waits on the events and returns the frames in submission order.
+    Anything queued on the GPU after submit(), e.g. the next frame's inference, runs while
+    the copy is in flight. On CPU-only machines frames are copied synchronously.
+    With a FrameRing, submit_to_ring() downloads (or on CPU converts) a frame straight into
+    a ring slot, which is published when it is collected.
+    """
+
+    def __init__(self, device, buffers=2, ring=None):
+        self.use_cuda = torch.device(device).type == 'cuda'
+        self.num_buffers = buffers
+        self.ring = ring
+        self.ring_registered = False
+        self.buffers = []
+        self.events = []
+        self.ring_events = []
+        self.next_buffer = 0
+        self.next_ring_event = 0
+        self.pending = []  # (buffer index, ring slot, tag)，二者只有一个不是None
+        self.ready = []  # (tag, frame)
+
+    def __len__(self):
+        return len(self.pending) + len(self.ready)
+
+    def submit(self, frame, tag=None):
+        """
+        Args:
+            frame (tensor): uint8 HWC frame on the render device
+            tag: returned together with the frame by collect()
+        """
+        if not self.use_cuda:
+            self.ready.append((tag, frame.cpu().numpy()))
+            return
+        if len(self.buffers) == 0 or self.buffers[0].shape != frame.shape:
+            self.collect_pending()
+            self.buffers = [torch.empty(frame.shape, dtype=frame.dtype, pin_memory=True)
+                            for _ in range(self.num_buffers)]
+            self.events = [torch.cuda.Event() for _ in range(self.num_buffers)]
+        if len(self.pending) == self.num_buffers:
+            # 缓冲区都在用，先取走最早的一帧
+            self.collect_one()
+        i = self.next_buffer
+        self.next_buffer = (i + 1) % self.num_buffers
+        self.buffers[i].copy_(frame, non_blocking=True)
+        self.events[i].record()
+        self.pending.append((i, None, tag))
+
+    def register_ring(self):
+        # 把共享内存注册成锁页内存，下载才能真正异步；注册失败时copy_退化成同步拷贝，结果不变
+        self.ring_events = [torch.cuda.Event() for _ in range(self.num_buffers)]
+        frames = self.ring.frames
+        result = torch.cuda.cudart().cudaHostRegister(frames.ctypes.data, frames.nbytes, 0)
+        # 只有注册成功时close()才需要取消注册
+        self.ring_registered = int(result) == 0
+        if not self.ring_registered:
+            print("Frame ring could not be pinned, downloads will be synchronous")
+
+    def close(self):
+        # 共享内存关闭或删除前要取消注册，否则驱动还持有这段映射
+        self.collect_pending()
+        if self.ring_registered:
+            torch.cuda.cudart().cudaHostUnregister(self.ring.frames.ctypes.data)
+            self.ring_registered = False
+
+    def submit_to_ring(self, produce, tag=None):
+        """
+        Args:
+            produce: produce(out=None) returns the uint8 HWC frame on the render device,
+                written into the given tensor when `out` is passed
+            tag: returned together with the frame by collect()
+        """
+        if not self.use_cuda:
+            # CPU上直接把查表结果写进槽位
+            slot, target = self.ring.acquire()
+            produce(out=torch.from_numpy(target))
+            self.ring.publish(slot)
+            self.ready.append((tag, target))
+            return
+        if len(self.ring_events) == 0:
+            self.register_ring()
+        frame = produce()
+        if len(self.pending) == self.num_buffers:
+            self.collect_one()
+        slot, target = self.ring.acquire()
+        i = self.next_ring_event
+        self.next_ring_event = (i + 1) % self.num_buffers
+        torch.from_numpy(target).copy_(frame, non_blocking=True)
+        self.ring_events[i].record()
+        self.pending.append((i, slot, tag))
+
+    def collect_one(self):
+        i, slot, tag = self.pending.pop(0)
+        if slot is None:
+            self.events[i].synchronize()
+            # 锁页缓冲区会被复用，交出去的是一份拷贝
+            self.ready.append((tag, self.buffers[i].numpy().copy()))
+        else:
+            self.ring_events[i].synchronize()
+            self.ring.publish(slot)
+            self.ready.append((tag, self.ring.frames[slot]))
+
+    def collect_pending(self):
+        while len(self.pending) > 0:
+            self.collect_one()
+
+    def collect(self):
+        """
+        Returns:
+            list of (tag, numpy frame) for every submitted frame, oldest first. Frames from
+            submit_to_ring() are views of ring slots that the writer reuses later, callers
+            copy them if they keep them.
+        """
+        self.collect_pending()
+        ready = self.ready
+        self.ready = []
+        return ready
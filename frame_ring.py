@@ -0,0 +1,108 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class FrameRing:
+    """
+    Ring of preallocated frame slots in shared memory, for one writer (the model process)
+    and one reader (the compositor).
+    Header layout (int64): [latest seq, slot held by reader, seq of slot 0, seq of slot 1, ...].
+    A slot's seq is -1 while it is being written. The writer never picks the slot the reader
+    currently holds, so the reader can use the newest frame in place without copying it.
+    acquire()/publish() let the writer render or download a frame straight into a slot.
+    """
+    HEADER_FIELDS = 2
+
+    def __init__(self, frame_shape, slots=4, name=None):
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots
+        self.frame_bytes = int(np.prod(self.frame_shape))
+        self.header_bytes = (self.HEADER_FIELDS + slots) * 8
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.header_bytes + slots * self.frame_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.header = np.ndarray((self.HEADER_FIELDS + slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((slots,) + self.frame_shape, dtype=np.uint8, buffer=self.shm.buf,
+                                 offset=self.header_bytes)
+        if self.owner:
+            self.header[0] = 0
+            self.header[1] = -1
+            self.header[self.HEADER_FIELDS:] = 0
+        self.next_slot = 0
+        self.read_seq = 0
+
+    def __getstate__(self):
+        # spawn启动的子进程按名字重新挂载同一块共享内存
+        return {'frame_shape': self.frame_shape, 'slots': self.slots, 'name': self.shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['frame_shape'], state['slots'], state['name'])
+
+    def acquire(self):
+        """
+        Reserve a slot to be written in place. It stays invisible to the reader until
+        publish(), and is never the slot the reader holds, the newest published slot or a
+        slot acquired earlier and not yet published.
+        Returns:
+            (slot, writable frame view)
+        """
+        latest = int(self.header[0])
+        for i in range(self.slots):
+            slot = (self.next_slot + i) % self.slots
+            seq = int(self.header[self.HEADER_FIELDS + slot])
+            if slot == self.header[1] or seq == -1 or (latest > 0 and seq == latest):
+                continue
+            # 先标记正在写入再确认读端没有持有，和read_latest先持有再确认的顺序相对，
+            # 两边总有一方能看到对方的标记
+            self.header[self.HEADER_FIELDS + slot] = -1
+            if slot == self.header[1]:
+                self.header[self.HEADER_FIELDS + slot] = seq
+                continue
+            self.next_slot = (slot + 1) % self.slots
+            return slot, self.frames[slot]
+        raise RuntimeError("No free slot in the frame ring, too many frames in flight")
+
+    def publish(self, slot):
+        seq = int(self.header[0]) + 1
+        self.header[self.HEADER_FIELDS + slot] = seq
+        self.header[0] = seq
+        return seq
+
+    def write(self, frame):
+        slot, target = self.acquire()
+        target[...] = frame
+        return self.publish(slot)
+
+    def read_latest(self):
+        """
+        Returns:
+            read-only view of the newest frame, or None if nothing new was written since the
+            last call. The view stays valid until the next call that returns a frame.
+        """
+        while True:
+            seq = int(self.header[0])
+            if seq == self.read_seq:
+                return None
+            for slot in range(self.slots):
+                if self.header[self.HEADER_FIELDS + slot] == seq:
+                    break
+            else:
+                continue  # 最新的槽位正被覆盖，重新读取
+            self.header[1] = slot
+            # 标记持有之后再确认一次，避免写端在标记前已经开始覆盖这个槽位
+            if self.header[self.HEADER_FIELDS + slot] != seq:
+                continue
+            self.read_seq = seq
+            frame = self.frames[slot]
+            frame.flags.writeable = False
+            return frame
+
+    def close(self):
+        self.header = None
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
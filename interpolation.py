@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+
+class FrameInterpolator:
+    """
+    Synthesizes output frames between the two newest model frames, so the output loop can
+    run at --fps while the model renders slower.
+    A new model frame is not shown at once: the output moves from the previous model frame
+    to the new one over one (estimated) model frame interval, which adds that much latency.
+    mode 'blend' cross-fades the two frames, mode 'flow' warps both towards each other with
+    DIS optical flow before blending, which avoids ghosting on moving edges.
+    """
+    MAX_INTERVAL = 0.25  # 两帧间隔超过这个时间（秒）就不再补帧，直接切换
+
+    def __init__(self, mode='blend'):
+        self.mode = mode
+        self.frames = [None, None]  # 预分配的两块缓冲区，轮流存放上一帧和当前帧
+        self.previous = None
+        self.current = None
+        self.push_time = None
+        self.interval = None
+        self.flows = None
+        self.dis = None
+        self.grid = None
+        if mode == 'flow':
+            self.dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+
+    def push(self, frame, t):
+        """
+        Args:
+            frame (ndarray): new HWC uint8 model frame, copied (it may be a view into the frame ring)
+            t (float): time.perf_counter() when it arrived
+        """
+        i = 0 if self.current is self.frames[1] else 1
+        if self.frames[i] is None or self.frames[i].shape != frame.shape:
+            self.frames[i] = np.empty_like(frame)
+        np.copyto(self.frames[i], frame)
+        self.previous = self.current
+        self.current = self.frames[i]
+        if self.push_time is not None:
+            elapsed = t - self.push_time
+            if elapsed > self.MAX_INTERVAL:
+                self.previous = None
+            else:
+                self.interval = elapsed if self.interval is None else 0.8 * self.interval + 0.2 * elapsed
+        self.push_time = t
+        self.flows = None
+
+    def frame(self, t):
+        """
+        Returns:
+            frame to show at time t, None before the first push
+        """
+        if self.previous is None or self.interval is None:
+            return self.current
+        alpha = (t - self.push_time) / self.interval
+        if alpha >= 1:
+            return self.current
+        alpha = max(0.0, alpha)
+        if self.mode == 'flow':
+            return self.warp_blend(alpha)
+        return cv2.addWeighted(self.previous, 1 - alpha, self.current, alpha, 0)
+
+    def luminance(self, frame):
+        # 透明区域的颜色没有意义，按alpha加权后再算光流
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY)
+        return cv2.multiply(gray, np.ascontiguousarray(frame[:, :, 3]), scale=1 / 255)
+
+    def warp_blend(self, alpha):
+        if self.flows is None:
+            previous = self.luminance(self.previous)
+            current = self.luminance(self.current)
+            # current(p) ≈ previous(p + flow_back(p))，previous(p) ≈ current(p + flow_forward(p))
+            self.flows = (self.dis.calc(current, previous, None), self.dis.calc(previous, current, None))
+            h, w = previous.shape
+            if self.grid is None or self.grid[0].shape != (h, w):
+                self.grid = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        flow_back, flow_forward = self.flows
+        grid_x, grid_y = self.grid
+        from_previous = cv2.remap(self.previous, grid_x + alpha * flow_back[:, :, 0],
+                                  grid_y + alpha * flow_back[:, :, 1], cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_REPLICATE)
+        from_current = cv2.remap(self.current, grid_x + (1 - alpha) * flow_forward[:, :, 0],
+                                 grid_y + (1 - alpha) * flow_forward[:, :, 1], cv2.INTER_LINEAR,
+                                 borderMode=cv2.BORDER_REPLICATE)
+        return cv2.addWeighted(from_previous, 1 - alpha, from_current, alpha, 0)
@@ -0,0 +1,90 @@
+import math
+
+
+def build_model_input(eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c):
+    pose_vector_c[3] = pose_vector_c[1]
+    pose_vector_c[4] = pose_vector_c[2]
+
+    model_input_arr = eyebrow_vector_c
+    model_input_arr.extend(mouth_eye_vector_c)
+    model_input_arr.extend(pose_vector_c)
+    return model_input_arr
+
+
+class LookAheadScheduler:
+    """
+    Samples the timelines already queued in ActionAnimeV2 at future frame times, so that
+    the model process can render them in batches before they are due.
+    Frame times are slots on a fixed grid: slot k is shown at k / fps.
+    """
+
+    def __init__(self, fps, frames, batch_size=None):
+        self.fps = fps
+        self.frames = frames
+        self.batch_size = max(1, frames // 2) if batch_size is None else batch_size
+        self.generation = None
+        self.scheduled_until = -1
+
+    def slot(self, t):
+        return int(t * self.fps)
+
+    def covers(self, generation, slot):
+        # 这个slot已经包含在发出去的批量输入里，结果还没回来时继续显示上一帧
+        return self.frames > 0 and generation == self.generation and slot <= self.scheduled_until
+
+    def schedule(self, action, now):
+        """
+        Args:
+            action (ActionAnimeV2): action state, already updated for the current frame
+            now (float): time.perf_counter() of the current frame
+        Returns:
+            None if nothing should be sent yet, else a batch message for the model process
+        """
+        if self.frames <= 0:
+            return None
+        if action.timeline_generation != self.generation:
+            self.generation = action.timeline_generation
+            self.scheduled_until = -1
+        horizon = action.horizon()
+        if horizon is None:
+            return None
+        cur_slot = self.slot(now)
+        start = max(cur_slot + 1, self.scheduled_until + 1)
+        end = min(cur_slot + self.frames, math.floor(horizon * self.fps))
+        if end - start + 1 < self.batch_size:
+            return None
+        slots = []
+        model_inputs = []
+        for slot in range(start, end + 1):
+            vector = action.sample_vector(slot / self.fps)
+            if vector is None:
+                break
+            slots.append(slot)
+            model_inputs.append(build_model_input(*vector))
+        if len(slots) == 0:
+            return None
+        self.scheduled_until = slots[-1]
+        return {'generation': self.generation, 'slots': slots, 'model_inputs': model_inputs}
+
+
+class PrerenderedFrames:
+    # 模型进程提前渲染好的帧，按slot存放
+    def __init__(self):
+        self.generation = None
+        self.frames = {}
+
+    def add(self, generation, slot, frame):
+        if self.generation is not None and generation < self.generation:
+            return
+        if generation != self.generation:
+            self.generation = generation
+            self.frames = {}
+        self.frames[slot] = frame
+
+    def pop(self, generation, slot):
+        if generation != self.generation:
+            self.frames = {}
+            return None
+        for outdated in [s for s in self.frames if s < slot]:
+            del self.frames[outdated]
+        return self.frames.pop(slot, None)
@@ -1,5 +1,9 @@
+import os
 import time
+from contextlib import nullcontext
 
+import numpy as np
+import torch
 import torch.nn as nn
 
 import tha2.poser.modes.mode_20
@@ -7,11 +11,16 @@ import tha3.poser.modes.standard_float
 import tha3.poser.modes.separable_float
 import tha3.poser.modes.standard_half
 import tha3.poser.modes.separable_half
+import tha3.poser.modes.standard_int8
+import tha3.poser.modes.separable_int8
 from torch.nn.functional import interpolate
 
-from args import args
+from tha3.nn.image_processing_util import apply_grid_change, apply_color_change
 
-from collections import OrderedDict
+from args import args
+from cache import FrameCache
+from onnx_backend import OnnxModule
+from roi import InstanceNormStats, face_region, pad_region, warp_tile
 
 
 class TalkingAnimeLight(nn.Module):
@@ -20,7 +29,7 @@ class TalkingAnimeLight(nn.Module):
         self.face_morpher = tha2.poser.modes.mode_20.load_face_morpher('pretrained/face_morpher.pt')
         self.two_algo_face_rotator = tha2.poser.modes.mode_20.load_face_rotater('pretrained/two_algo_face_rotator.pt')
         self.combiner = tha2.poser.modes.mode_20.load_combiner('pretrained/combiner.pt')
-        self.face_cache = OrderedDict()
+        self.face_cache = FrameCache(args.max_gpu_cache_bytes, policy=args.cache_policy)
         self.tot = 0
         self.hit = 0
 
@@ -28,18 +37,15 @@ class TalkingAnimeLight(nn.Module):
         x = image.clone()
         if args.perf == 'model':
             tic = time.perf_counter()
-        input_hash = hash(tuple(mouth_eye_vector_c))
-        cached = self.face_cache.get(input_hash)
+        face_key = np.asarray(mouth_eye_vector_c, dtype=np.float32)
+        cached = self.face_cache.get(face_key)
         self.tot += 1
         if cached is None:
             mouth_eye_morp_image = self.face_morpher(image[:, :, 32:224, 32:224], mouth_eye_vector)
-            self.face_cache[input_hash] = mouth_eye_morp_image.detach()
-            if len(self.face_cache) > args.max_gpu_cache_len:
-                self.face_cache.popitem(last=False)
+            self.face_cache.put(face_key, mouth_eye_morp_image.detach())
         else:
             self.hit += 1
             mouth_eye_morp_image = cached
-            self.face_cache.move_to_end(input_hash)
         if args.debug and ratio is not None:
             ratio.value = self.hit / self.tot
         if args.perf == 'model':
@@ -57,108 +63,331 @@ class TalkingAnimeLight(nn.Module):
         return output_image
 
 
+class ImageContext:
+    """
+    Static tensors derived from one character image, built once per image.
+    `full` (editor input, `size` pixels) and `half` (rotator input) are persistent buffers:
+    every frame only the face patch is written back into them, downsampled for the
+    smaller ones. Face box offsets are multiples of the downscale factor, so the partial
+    bilinear downsample gives exactly the same pixels as downsampling the whole image.
+    """
+
+    def __init__(self, image, eyebrow_decomposer=None, size=512):
+        self.image = image
+        self.size = size
+        self.face_image = image[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)].clone()
+        self.eyebrow_decomposer_output = None
+        if eyebrow_decomposer is not None:
+            self.eyebrow_decomposer_output = [
+                t.detach() for t in eyebrow_decomposer(image[:, :, 64:192, 64 + 128:192 + 128].clone())]
+        if size == 512:
+            self.full = image.clone()
+        else:
+            self.full = interpolate(image, size=(size, size), mode='bilinear', align_corners=False)
+        self.half = interpolate(image, size=(size // 2, size // 2), mode='bilinear', align_corners=False)
+        self.batch_full = None
+        self.batch_half = None
+
+    def buffers(self, n):
+        if n == 1:
+            return self.full, self.half
+        # 批量渲染只保留最近一种batch大小的缓冲区
+        if self.batch_full is None or self.batch_full.shape[0] != n:
+            self.batch_full = self.full.repeat(n, 1, 1, 1)
+            self.batch_half = self.half.repeat(n, 1, 1, 1)
+        return self.batch_full, self.batch_half
+
+    def update_face(self, face_image):
+        full, half = self.buffers(face_image.shape[0])
+        self.paste_face(full, face_image)
+        self.paste_face(half, face_image)
+        return full, half
+
+    @staticmethod
+    def paste_face(buffer, face_image):
+        k = 512 // buffer.shape[-1]
+        top, left, size = 32 // k, (32 + 128) // k, 192 // k
+        if k > 1:
+            face_image = interpolate(face_image, size=(size, size), mode='bilinear', align_corners=False)
+        buffer[:, :, top:top + size, left:left + size] = face_image
+
+
+MODEL_MODES = {
+    'standard_float': tha3.poser.modes.standard_float,
+    'standard_half': tha3.poser.modes.standard_half,
+    'separable_float': tha3.poser.modes.separable_float,
+    'separable_half': tha3.poser.modes.separable_half,
+    # 只能在CPU上运行，权重由 python benchmark.py int8 校准生成
+    'standard_int8': tha3.poser.modes.standard_int8,
+    'separable_int8': tha3.poser.modes.separable_int8,
+}
+
+# 各网络的加载函数名和追踪/导出用的示例输入尺寸（batch为1）
+NETWORKS = {
+    'eyebrow_decomposer': ('load_eyebrow_decomposer', [(1, 4, 128, 128)]),
+    'eyebrow_morphing_combiner': ('load_eyebrow_morphing_combiner', [(1, 4, 128, 128), (1, 4, 128, 128), (1, 12)]),
+    'face_morpher': ('load_face_morpher', [(1, 4, 192, 192), (1, 27)]),
+    'two_algo_face_body_rotator': ('load_two_algo_generator', [(1, 4, 256, 256), (1, 6)]),
+    'editor': ('load_editor', [(1, 4, 512, 512), (1, 4, 512, 512), (1, 2, 512, 512), (1, 6)]),
+}
+
+
+def scaled_input_shapes(name, scale):
+    # --render_scale只缩小旋转和编辑网络的输入
+    shapes = NETWORKS[name][1]
+    if scale == 1 or name not in ('two_algo_face_body_rotator', 'editor'):
+        return shapes
+    return [shape[:2] + (int(shape[2] * scale), int(shape[3] * scale)) if len(shape) == 4 else shape
+            for shape in shapes]
+
+
+def load_eager_network(variant, name, optimize=False):
+    return getattr(MODEL_MODES[variant], NETWORKS[name][0])(f'data/models/{variant}/{name}.pt', optimize)
+
+
+def load_network(name, device=None, trace=True):
+    """
+    Load one tha3 network of args.model.
+    With --backend onnxruntime the exported data/models/<variant>/<name>.onnx is run by
+    ONNX Runtime instead (see export_onnx.py).
+    With --torchscript the network is traced once on `device` and saved as
+    data/models/<variant>/<name>.<device type>.ts; later starts load that file directly.
+    The artifact is rebuilt when the .pt weights are newer.
+    """
+    input_shapes = scaled_input_shapes(name, args.render_scale)
+    path = f'data/models/{args.model}/{name}.pt'
+    if args.backend == 'onnxruntime':
+        return OnnxModule(f'data/models/{args.model}/{name}.onnx', args.ort_threads)
+    if not args.torchscript or device is None or not trace:
+        return load_eager_network(args.model, name, args.optimize)
+    device = torch.device(device)
+    suffix = '.opt' if args.optimize else ''
+    if input_shapes != NETWORKS[name][1]:
+        suffix += f'.{input_shapes[0][2]}'
+    script_path = f'data/models/{args.model}/{name}{suffix}.{device.type}.ts'
+    if os.path.exists(script_path) and os.path.getmtime(script_path) >= os.path.getmtime(path):
+        print(f"Loading traced {name} ... ", end="")
+        module = torch.jit.load(script_path, map_location=device)
+        print("DONE!!!")
+        return module
+    module = load_eager_network(args.model, name, args.optimize).to(device).eval()
+    dtype = torch.half if args.half else torch.float
+    example_inputs = tuple(torch.zeros(shape, dtype=dtype, device=device) for shape in input_shapes)
+    print(f"Tracing {name} ... ", end="")
+    with torch.no_grad():
+        module = torch.jit.trace(module, example_inputs, strict=False, check_trace=False)
+    torch.jit.save(module, script_path)
+    print("DONE!!!")
+    return module
+
+
 class TalkingAnime3(nn.Module):
-    def __init__(self):
+    def __init__(self, device=None):
         super(TalkingAnime3, self).__init__()
-        if args.model == "standard_float":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.standard_float.load_eyebrow_decomposer(
-                    'data/models/standard_float/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.standard_float.load_eyebrow_morphing_combiner(
-                    'data/models/standard_float/eyebrow_morphing_combiner.pt')
-            self.face_morpher = tha3.poser.modes.standard_float.load_face_morpher(
-                'data/models/standard_float/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.standard_float.load_two_algo_generator(
-                'data/models/standard_float/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.standard_float.load_editor('data/models/standard_float/editor.pt')
-        elif args.model == "standard_half":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.standard_half.load_eyebrow_decomposer(
-                    'data/models/standard_half/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.standard_half.load_eyebrow_morphing_combiner(
-                    'data/models/standard_half/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.standard_half.load_face_morpher(
-                'data/models/standard_half/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.standard_half.load_two_algo_generator(
-                'data/models/standard_half/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.standard_half.load_editor('data/models/standard_half/editor.pt')
-        elif args.model == "separable_float":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.separable_float.load_eyebrow_decomposer(
-                    'data/models/separable_float/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.separable_float.load_eyebrow_morphing_combiner(
-                    'data/models/separable_float/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.separable_float.load_face_morpher(
-                'data/models/separable_float/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.separable_float.load_two_algo_generator(
-                'data/models/separable_float/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.separable_float.load_editor('data/models/separable_float/editor.pt')
-        elif args.model == "separable_half":
-            if args.eyebrow:
-                self.eyebrow_decomposer = tha3.poser.modes.separable_half.load_eyebrow_decomposer(
-                    'data/models/separable_half/eyebrow_decomposer.pt')
-                self.eyebrow_morphing_combiner = tha3.poser.modes.separable_half.load_eyebrow_morphing_combiner(
-                    'data/models/separable_half/eyebrow_morphing_combiner.pt')
-
-            self.face_morpher = tha3.poser.modes.separable_half.load_face_morpher(
-                'data/models/separable_half/face_morpher.pt')
-            self.two_algo_face_body_rotator = tha3.poser.modes.separable_half.load_two_algo_generator(
-                'data/models/separable_half/two_algo_face_body_rotator.pt')
-            self.editor = tha3.poser.modes.separable_half.load_editor('data/models/separable_half/editor.pt')
-        else:
+        if args.model not in MODEL_MODES:
             raise RuntimeError("Invalid model: '%s'" % args.model)
-        self.face_cache = OrderedDict()
+        if args.render_scale != 1 and args.backend == 'onnxruntime':
+            raise RuntimeError("--render_scale needs the torch backend, ONNX graphs are exported at 512x512")
+        if args.eyebrow:
+            # 每张图只跑一次，不需要追踪
+            self.eyebrow_decomposer = load_network('eyebrow_decomposer', device, trace=False)
+            self.eyebrow_morphing_combiner = load_network('eyebrow_morphing_combiner', device)
+        self.face_morpher = load_network('face_morpher', device)
+        self.two_algo_face_body_rotator = load_network('two_algo_face_body_rotator', device)
+        self.editor = load_network('editor', device)
+        # 追踪或导出得到的图把batch大小固定成了1
+        self.traced = (args.torchscript and device is not None) or args.backend == 'onnxruntime'
+        self.face_cache = FrameCache(args.max_gpu_cache_bytes, args.cache_tolerance, args.cache_policy)
+        self.image_context = None
+        self.render_size = int(512 * args.render_scale)
         self.tot = 0
         self.hit = 0
+        # --roi：姿势不变时只重算脸部所在的区域，需要能拆开调用的eager编辑器
+        self.roi = args.roi and not self.traced and self.render_size == 512
+        self.roi_state = None
+        self.roi_last_pose = None  # 上一次整帧渲染的姿势
+        if self.roi:
+            self.editor_norm_stats = InstanceNormStats(self.editor)
 
-    def forward(self, image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c, eyebrow_vector_c,
-                ratio=None):
+    @torch.no_grad()
+    def prepare_image(self, image):
+        # 只和角色图片有关的中间结果，换图时重新计算一次
+        self.face_cache.clear()
+        self.roi_state = None
+        self.roi_last_pose = None
+        self.image_context = ImageContext(image, self.eyebrow_decomposer if args.eyebrow else None, self.render_size)
+        return self.image_context
+
+    def forward(self, image, mouth_eye_vector, pose_vector, eyebrow_vector, face_key, ratio=None):
         if args.perf == 'model':
             tic = time.perf_counter()
-        x = image.clone()
-        if args.eyebrow:
-            input_hash = hash(tuple(eyebrow_vector_c + mouth_eye_vector_c))
-        else:
-            input_hash = hash(tuple(mouth_eye_vector_c))
-        cached = self.face_cache.get(input_hash)
+        if self.image_context is None or image is not self.image_context.image:
+            self.prepare_image(image)
+        context = self.image_context
+        # face_key是眉毛+表情参数（或仅表情参数）的量化key
+        cached = self.face_cache.get(face_key)
         self.tot += 1
         if cached is None:
-            face_image = x[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)].clone()
+            face_image = context.face_image
             if args.eyebrow:
-                eyebrow_morp_image = self.eyebrow_decomposer(x[:, :, 64:192, 64 + 128:192 + 128].clone())
+                eyebrow_morp_image = context.eyebrow_decomposer_output
                 eyebrow_morp_image = \
                 self.eyebrow_morphing_combiner(eyebrow_morp_image[3], eyebrow_morp_image[0], eyebrow_vector)[2]
+                face_image = face_image.clone()
                 face_image[:, :, 32:32 + 128, 32:32 + 128] = eyebrow_morp_image
             mouth_eye_morp_image = self.face_morpher(face_image, mouth_eye_vector)[0]
-            self.face_cache[input_hash] = mouth_eye_morp_image.detach()
-            if len(self.face_cache) > args.max_gpu_cache_len:
-                self.face_cache.popitem(last=False)
+            self.face_cache.put(face_key, mouth_eye_morp_image.detach())
         else:
             self.hit += 1
             mouth_eye_morp_image = cached
-            self.face_cache.move_to_end(input_hash)
         if args.debug and ratio is not None:
             ratio.value = self.hit / self.tot
         if args.perf == 'model':
             print(" - face_morpher", (time.perf_counter() - tic) * 1000)
             tic = time.perf_counter()
-        x[:, :, 32:32 + 192, (32 + 128):(32 + 192 + 128)] = mouth_eye_morp_image
-        x_half = interpolate(x, size=(256, 256), mode='bilinear', align_corners=False)
+        output_image = self.render_face_morphed(context, mouth_eye_morp_image, pose_vector)
+        return output_image
+
+    def render_face_morphed(self, context, face_image, pose_vector):
+        roi = self.roi and pose_vector.shape[0] == 1
+        if roi and self.roi_state is not None:
+            state = self.roi_state
+            if state['context'] is context and torch.equal(state['pose'], pose_vector):
+                return self.render_face_roi(state, face_image, pose_vector)
+        if roi:
+            # 姿势和上一次整帧相同，说明姿势停住了，这一帧的状态才可能被后面的帧复用；
+            # 一直在动的时候不保存状态，也不统计instance norm
+            last_pose, self.roi_last_pose = self.roi_last_pose, pose_vector.clone()
+            roi = last_pose is not None and torch.equal(last_pose, pose_vector)
+            self.roi_state = None
+        if args.perf == 'model':
+            tic = time.perf_counter()
+        x, x_half = context.update_face(face_image)
         rotate_image = self.two_algo_face_body_rotator(x_half, pose_vector)
         if args.perf == 'model':
             print(" - rotator", (time.perf_counter() - tic) * 1000)
             tic = time.perf_counter()
-        output_image = self.editor(x,
-                                   interpolate(rotate_image[1], size=(512, 512), mode='bilinear', align_corners=False),
-                                   interpolate(rotate_image[2], size=(512, 512), mode='bilinear', align_corners=False),
-                                   pose_vector)[0]
+        size = context.size
+        grid_change = interpolate(rotate_image[2], size=(size, size), mode='bilinear', align_corners=False)
+        face_tile = self.face_tile(rotate_image[2]) if roi else None
+        if face_tile is not None:
+            region, tile = face_tile
+            # 看不到脸时不会重跑编辑器，不需要统计量
+            with self.editor_norm_stats.record() if tile is not None else nullcontext():
+                output_image = self.editor(x,
+                                           interpolate(rotate_image[1], size=(size, size), mode='bilinear',
+                                                       align_corners=False),
+                                           grid_change,
+                                           pose_vector)[0]
+            self.roi_state = {
+                'context': context,
+                'pose': pose_vector.clone(),
+                'grid_change_half': rotate_image[2].detach(),
+                'grid_change': grid_change.detach(),
+                'output': output_image.detach(),
+                'region': region,
+                'tile': tile,
+            }
+        else:
+            output_image = self.editor(x,
+                                       interpolate(rotate_image[1], size=(size, size), mode='bilinear',
+                                                   align_corners=False),
+                                       grid_change,
+                                       pose_vector)[0]
+        if size != 512:
+            # 低分辨率渲染的结果用双三次插值放大回512，在线性空间中进行
+            output_image = interpolate(output_image, size=(512, 512), mode='bicubic', align_corners=False)
+            output_image = output_image.clamp(-1.0, 1.0)
         if args.perf == 'model':
             print(" - editor", (time.perf_counter() - tic) * 1000)
+        return output_image
+
+    def face_tile(self, grid_change_half):
+        """
+        Returns:
+            (region, tile) of the face in the output, both None if the face is not visible,
+            or None if the tile is too large for --roi to pay off
+        """
+        # 输出中从脸部补丁取样的区域；编辑器只在这块外扩后的tile上重跑，
+        # tile边长对齐到32，保证UNet每一级下采样都能整除
+        region = face_region(grid_change_half)
+        if region is None:
+            return None, None
+        tile = pad_region(region, 64, align=32)
+        if (tile[1] - tile[0]) * (tile[3] - tile[2]) > 512 * 512 // 2:
+            # tile太大省不了多少，直接整帧渲染
+            return None
+        return pad_region(region, 16), tile
+
+    def render_face_roi(self, state, face_image, pose_vector):
+        """
+        Render a frame whose pose equals the last full frame, e.g. a blink or lip-sync frame.
+        The rotator is skipped (its grid change from the last full frame is reused) and the
+        editor only runs on the tile around the face, with the instance norm statistics of
+        the last full frame. The result is composited into the last full output, so it is
+        an approximation of a full render, not bit-exact.
+        """
+        if args.perf == 'model':
             tic = time.perf_counter()
+        x, x_half = state['context'].update_face(face_image)
+        output_image = state['output'].clone()
+        if state['tile'] is None:
+            return output_image
+        top, bottom, left, right = tile = state['tile']
+        warped = interpolate(apply_grid_change(state['grid_change_half'], x_half), size=(512, 512),
+                             mode='bilinear', align_corners=False)[:, :, top:bottom, left:right]
+        grid_change = state['grid_change'][:, :, top:bottom, left:right]
+        n, c = pose_vector.shape
+        pose = pose_vector.view(n, c, 1, 1).repeat(1, 1, bottom - top, right - left)
+        editor = self.editor
+        with self.editor_norm_stats.replay():
+            feature = editor.body(torch.cat([x[:, :, top:bottom, left:right], warped, grid_change, pose], dim=1))[-1]
+            output_grid_change = grid_change + editor.grid_change_creator(feature)
+            color_change = editor.color_change_creator(feature)
+            alpha = editor.alpha_creator(feature)
+        tile_image = apply_color_change(alpha, color_change, warp_tile(x, output_grid_change, tile))
+        r_top, r_bottom, r_left, r_right = state['region']
+        output_image[:, :, r_top:r_bottom, r_left:r_right] = \
+            tile_image[:, :, r_top - top:r_bottom - top, r_left - left:r_right - left]
+        if args.perf == 'model':
+            print(" - editor roi %dx%d" % (bottom - top, right - left), (time.perf_counter() - tic) * 1000)
         return output_image
 
+    @torch.no_grad()
+    def forward_batch(self, image, mouth_eye_vectors, pose_vectors, eyebrow_vectors=None):
+        """
+        Render several poses of the same character image in one pass of each network.
+        Args:
+            image (tensor): [1, 4, 512, 512] character image
+            mouth_eye_vectors (tensor): [B, 27]
+            pose_vectors (tensor): [B, 6]
+            eyebrow_vectors (tensor): [B, 12], only used with --eyebrow
+        Returns:
+            tensor: [B, 4, 512, 512] output images
+        """
+        n = pose_vectors.shape[0]
+        if self.traced and n > 1:
+            return torch.cat([self.forward_batch(image, mouth_eye_vectors[i:i + 1], pose_vectors[i:i + 1],
+                                                 None if eyebrow_vectors is None else eyebrow_vectors[i:i + 1])
+                              for i in range(n)])
+        if args.perf == 'model':
+            tic = time.perf_counter()
+        if self.image_context is None or image is not self.image_context.image:
+            self.prepare_image(image)
+        context = self.image_context
+        face_image = context.face_image.expand(n, -1, -1, -1)
+        if args.eyebrow:
+            decomposer_output = context.eyebrow_decomposer_output
+            eyebrow_morp_image = self.eyebrow_morphing_combiner(decomposer_output[3].expand(n, -1, -1, -1),
+                                                                decomposer_output[0].expand(n, -1, -1, -1),
+                                                                eyebrow_vectors)[2]
+            face_image = face_image.clone()
+            face_image[:, :, 32:32 + 128, 32:32 + 128] = eyebrow_morp_image
+        mouth_eye_morp_image = self.face_morpher(face_image, mouth_eye_vectors)[0]
+        if args.perf == 'model':
+            print(" - face_morpher x%d" % n, (time.perf_counter() - tic) * 1000)
+        return self.render_face_morphed(context, mouth_eye_morp_image, pose_vectors)
+
 
 class TalkingAnime(nn.Module):
     def __init__(self):
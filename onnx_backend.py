@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+
+
+class OnnxModule:
+    """
+    Runs an exported tha3 network with ONNX Runtime on the CPU. Takes and returns torch
+    tensors like the module it was exported from, so TalkingAnime3 can use it unchanged.
+    onnxruntime is only imported when this backend is selected.
+    """
+
+    def __init__(self, path, threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        print(f"Loading {path} with onnxruntime ... ", end="")
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        print("DONE!!!")
+
+    def __call__(self, *inputs):
+        # expand出来的张量不连续，onnxruntime需要连续的float32内存
+        feed = {name: np.ascontiguousarray(x.detach().float().cpu().numpy())
+                for name, x in zip(self.input_names, inputs)}
+        return [torch.from_numpy(output) for output in self.session.run(None, feed)]
@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+
+import torch
+from torch.nn import InstanceNorm2d
+from torch.nn.functional import grid_sample
+
+# 512分辨率下脸部补丁的位置 (top, bottom, left, right)，和ImageContext.update_face一致
+FACE_BOX = (32, 32 + 192, 32 + 128, 32 + 192 + 128)
+
+
+class InstanceNormStats:
+    """
+    Forward hooks on every InstanceNorm2d of a module.
+    Inside record() the per-channel mean/var of each norm input is kept; inside replay() the
+    norms use those recorded statistics instead of the statistics of their current input, so
+    a tile cut out of the frame is normalized the same way as inside the whole frame.
+    """
+
+    def __init__(self, module):
+        self.mode = None
+        self.stats = {}
+        self.handles = [m.register_forward_hook(self.hook) for m in module.modules() if isinstance(m, InstanceNorm2d)]
+
+    def hook(self, module, inputs, output):
+        x = inputs[0]
+        if self.mode == 'record':
+            self.stats[module] = (x.mean(dim=(2, 3), keepdim=True), x.var(dim=(2, 3), keepdim=True, unbiased=False))
+        elif self.mode == 'replay':
+            mean, var = self.stats[module]
+            x = (x - mean) * torch.rsqrt(var + module.eps)
+            if module.affine:
+                x = x * module.weight.view(1, -1, 1, 1) + module.bias.view(1, -1, 1, 1)
+            return x.to(output.dtype)
+
+    @contextmanager
+    def record(self):
+        self.mode = 'record'
+        try:
+            yield
+        finally:
+            self.mode = None
+
+    @contextmanager
+    def replay(self):
+        self.mode = 'replay'
+        try:
+            yield
+        finally:
+            self.mode = None
+
+
+def pixel_centers(size, dtype, device):
+    # affine_grid(align_corners=False)的像素中心坐标
+    return (torch.arange(size, dtype=dtype, device=device) * 2 + 1) / size - 1
+
+
+def face_region(grid_change, size=512, box=FACE_BOX):
+    """
+    Args:
+        grid_change (tensor): [1, 2, h, w] grid change of the rotator
+    Returns:
+        (top, bottom, left, right) at `size` of the output pixels that sample from the face
+        box, or None if the face is not visible
+    """
+    _, _, h, w = grid_change.shape
+    source_x = pixel_centers(w, grid_change.dtype, grid_change.device).view(1, w) + grid_change[0, 0]
+    source_y = pixel_centers(h, grid_change.dtype, grid_change.device).view(h, 1) + grid_change[0, 1]
+    top, bottom, left, right = [v * 2 / size - 1 for v in box]
+    mask = (source_x >= left) & (source_x <= right) & (source_y >= top) & (source_y <= bottom)
+    rows = torch.nonzero(mask.any(dim=1)).view(-1).tolist()
+    cols = torch.nonzero(mask.any(dim=0)).view(-1).tolist()
+    if len(rows) == 0:
+        return None
+    scale = size // h
+    return rows[0] * scale, (rows[-1] + 1) * scale, cols[0] * scale, (cols[-1] + 1) * scale
+
+
+def pad_region(region, margin, align=1, size=512):
+    top, bottom, left, right = region
+    return (max(0, (top - margin) // align * align),
+            min(size, -(-(bottom + margin) // align) * align),
+            max(0, (left - margin) // align * align),
+            min(size, -(-(right + margin) // align) * align))
+
+
+def warp_tile(image, grid_change, tile):
+    """
+    GridChangeApplier.apply for the `tile` of the output only, sampling from the whole image.
+    Args:
+        image (tensor): [n, c, H, W] source image
+        grid_change (tensor): [n, 2, tile h, tile w] grid change of the tile, in whole-image units
+    """
+    top, bottom, left, right = tile
+    _, _, h, w = image.shape
+    xs = pixel_centers(w, grid_change.dtype, grid_change.device)[left:right]
+    ys = pixel_centers(h, grid_change.dtype, grid_change.device)[top:bottom]
+    base_grid = torch.stack(torch.meshgrid(xs, ys, indexing='xy'), dim=2).unsqueeze(0)
+    grid = base_grid + grid_change.permute(0, 2, 3, 1)
+    return grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=False)
@@ -1,13 +1,17 @@
 import torch
-import cv2
 import zlib
 import numpy as np
 from PIL import Image
 
 import tha2.poser.modes.mode_20_wx
 from models import TalkingAnime3
-from utils import preprocessing_image
+from tha3.nn.image_processing_util import AffineWarper
+from utils import preprocessing_image, linear_rgba2srgb_uint8
 from action_animeV2 import ActionAnimeV2
+from lookahead import LookAheadScheduler, PrerenderedFrames, build_model_input
+from interpolation import FrameInterpolator
+from compositor import Compositor, output_matrix
+from sinks import SocketSink
 from alive import AliveS
 from multiprocessing import Value, Process, Queue
 import multiprocessing
@@ -18,8 +22,10 @@ import time
 import math
 import collections
 from collections import OrderedDict
-from args import args
-from tha3.util import torch_linear_to_srgb
+from args import args, convert_to_byte
+from cache import DiskFrameCache, FrameCache, image_hash
+from frame_ring import FrameRing
+from frame_download import FrameDownloader
 # from pyanime4k import ac
 import socket
 import warnings
@@ -34,9 +40,9 @@ app = Flask(__name__)
 api = Api(app)
 
 
-def convert_linear_to_srgb(image: torch.Tensor) -> torch.Tensor:
-    rgb_image = torch_linear_to_srgb(image[0:3, :, :])
-    return torch.cat([rgb_image, image[3:4, :, :]], dim=0)
+def postprocess_output_image(output_image: torch.Tensor, out=None) -> torch.Tensor:
+    # 转换在模型所在设备上完成，下载到内存交给FrameDownloader
+    return linear_rgba2srgb_uint8(output_image.detach(), out=out)
 
 
 class FPS:
@@ -54,6 +60,58 @@ class FPS:
 ifm_converter = tha2.poser.modes.mode_20_wx.IFacialMocapPoseConverter20()
 
 
+def build_simplify_table(simplify):
+    # 每种simplify档位下各参数的量化精度，0表示不量化
+    simplify_arr = [1000] * ifm_converter.pose_size
+    if simplify >= 1:
+        simplify_arr = [200] * ifm_converter.pose_size
+        simplify_arr[ifm_converter.eye_wink_left_index] = 50
+        simplify_arr[ifm_converter.eye_wink_right_index] = 50
+        simplify_arr[ifm_converter.eye_happy_wink_left_index] = 50
+        simplify_arr[ifm_converter.eye_happy_wink_right_index] = 50
+        simplify_arr[ifm_converter.eye_surprised_left_index] = 30
+        simplify_arr[ifm_converter.eye_surprised_right_index] = 30
+        simplify_arr[ifm_converter.iris_rotation_x_index] = 25
+        simplify_arr[ifm_converter.iris_rotation_y_index] = 25
+        simplify_arr[ifm_converter.eye_raised_lower_eyelid_left_index] = 10
+        simplify_arr[ifm_converter.eye_raised_lower_eyelid_right_index] = 10
+        simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 5
+        simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 5
+        simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 5
+        simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 5
+    if simplify >= 2:
+        simplify_arr[ifm_converter.head_x_index] = 100
+        simplify_arr[ifm_converter.head_y_index] = 100
+        simplify_arr[ifm_converter.eye_surprised_left_index] = 10
+        simplify_arr[ifm_converter.eye_surprised_right_index] = 10
+        simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 0
+        simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 0
+        simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 0
+        simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 0
+    if simplify >= 3:
+        simplify_arr[ifm_converter.iris_rotation_x_index] = 20
+        simplify_arr[ifm_converter.iris_rotation_y_index] = 20
+        simplify_arr[ifm_converter.eye_wink_left_index] = 32
+        simplify_arr[ifm_converter.eye_wink_right_index] = 32
+        simplify_arr[ifm_converter.eye_happy_wink_left_index] = 32
+        simplify_arr[ifm_converter.eye_happy_wink_right_index] = 32
+    if simplify >= 4:
+        simplify_arr[ifm_converter.head_x_index] = 50
+        simplify_arr[ifm_converter.head_y_index] = 50
+        simplify_arr[ifm_converter.neck_z_index] = 100
+        simplify_arr[ifm_converter.iris_rotation_x_index] = 10
+        simplify_arr[ifm_converter.iris_rotation_y_index] = 10
+        simplify_arr[ifm_converter.eye_wink_left_index] = 24
+        simplify_arr[ifm_converter.eye_wink_right_index] = 24
+        simplify_arr[ifm_converter.eye_happy_wink_left_index] = 24
+        simplify_arr[ifm_converter.eye_happy_wink_right_index] = 24
+        simplify_arr[ifm_converter.eye_surprised_left_index] = 8
+        simplify_arr[ifm_converter.eye_surprised_right_index] = 8
+    for i in range(4, simplify):
+        simplify_arr = [max(math.ceil(x * 0.8), 5) for x in simplify_arr]
+    return np.array(simplify_arr, dtype=np.float64)
+
+
 class ModelClientProcess(Process):
     def __init__(self, input_image, device, model_process_args):
         super().__init__()
@@ -63,28 +121,166 @@ class ModelClientProcess(Process):
         self.data = None
         self.input_image = input_image
         self.output_queue = model_process_args['output_queue']
+        self.frame_ring = model_process_args['frame_ring']
         self.input_queue = model_process_args['input_queue']
         self.model_fps_number = Value('f', 0.0)
         self.gpu_fps_number = Value('f', 0.0)
         self.cache_hit_ratio = Value('f', 0.0)
         self.gpu_cache_hit_ratio = Value('f', 0.0)
         self.input_image_q = model_process_args['input_image_q']
+        self.disk_cache = None
+        self.downloader = None
+        self.warper = None
+        self.output_matrix = None
+        simplify_table = build_simplify_table(args.simplify)
+        self.simplify_mask = simplify_table > 0
+        self.simplify_scale = np.where(self.simplify_mask, simplify_table, 1000)
+
+    def simplify_model_input(self, model_input):
+        if args.simplify >= 2:
+            model_input[ifm_converter.eye_wink_left_index] += model_input[
+                ifm_converter.eye_happy_wink_left_index]
+            model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
+                                                                       ifm_converter.eye_wink_left_index] / 2
+            model_input[ifm_converter.eye_wink_left_index] = model_input[
+                                                                 ifm_converter.eye_wink_left_index] / 2
+            model_input[ifm_converter.eye_wink_right_index] += model_input[
+                ifm_converter.eye_happy_wink_right_index]
+            model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
+                                                                        ifm_converter.eye_wink_right_index] / 2
+            model_input[ifm_converter.eye_wink_right_index] = model_input[
+                                                                  ifm_converter.eye_wink_right_index] / 2
+
+            uosum = model_input[ifm_converter.mouth_uuu_index] + \
+                    model_input[ifm_converter.mouth_ooo_index]
+            model_input[ifm_converter.mouth_ooo_index] = uosum
+            model_input[ifm_converter.mouth_uuu_index] = 0
+            is_open = (model_input[ifm_converter.mouth_aaa_index] + model_input[
+                ifm_converter.mouth_iii_index] + uosum) > 0
+            model_input[ifm_converter.mouth_lowered_corner_left_index] = 0
+            model_input[ifm_converter.mouth_lowered_corner_right_index] = 0
+            model_input[ifm_converter.mouth_raised_corner_left_index] = 0.5 if is_open else 0
+            model_input[ifm_converter.mouth_raised_corner_right_index] = 0.5 if is_open else 0
+        if args.simplify >= 4:
+            model_input[ifm_converter.eye_raised_lower_eyelid_left_index] = 0
+            model_input[ifm_converter.eye_raised_lower_eyelid_right_index] = 0
+            model_input[ifm_converter.eye_wink_left_index] += model_input[
+                ifm_converter.eye_wink_right_index]
+            model_input[ifm_converter.eye_wink_right_index] = model_input[
+                                                                  ifm_converter.eye_wink_left_index] / 2
+            model_input[ifm_converter.eye_wink_left_index] = model_input[
+                                                                 ifm_converter.eye_wink_left_index] / 2
+
+            model_input[ifm_converter.eye_surprised_left_index] += model_input[
+                ifm_converter.eye_surprised_right_index]
+            model_input[ifm_converter.eye_surprised_right_index] = model_input[
+                                                                       ifm_converter.eye_surprised_left_index] / 2
+            model_input[ifm_converter.eye_surprised_left_index] = model_input[
+                                                                      ifm_converter.eye_surprised_left_index] / 2
+
+            model_input[ifm_converter.eye_happy_wink_left_index] += model_input[
+                ifm_converter.eye_happy_wink_right_index]
+            model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
+                                                                        ifm_converter.eye_happy_wink_left_index] / 2
+            model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
+                                                                       ifm_converter.eye_happy_wink_left_index] / 2
+            model_input[ifm_converter.mouth_aaa_index] = min(
+                model_input[ifm_converter.mouth_aaa_index] +
+                model_input[ifm_converter.mouth_ooo_index] / 2 +
+                model_input[ifm_converter.mouth_iii_index] / 2 +
+                model_input[ifm_converter.mouth_uuu_index] / 2, 1
+            )
+            model_input[ifm_converter.mouth_ooo_index] = 0
+            model_input[ifm_converter.mouth_iii_index] = 0
+            model_input[ifm_converter.mouth_uuu_index] = 0
+        # 一次性向量化量化：量化后的整数步数直接作为缓存key，未量化的参数按千分之一精度取整
+        model_input = np.asarray(model_input, dtype=np.float64)
+        steps = np.rint(model_input * self.simplify_scale)
+        model_input = np.where(self.simplify_mask, steps / self.simplify_scale, model_input)
+        key = np.clip(steps, -32768, 32767).astype(np.int16)
+        return model_input.astype(np.float32), key
+
+    def postprocess(self, output_image, out=None):
+        if self.warper is not None:
+            # 在显存里直接变换到--output_size；线性空间的-1是透明黑，平移到0再用零填充边界
+            output_image = self.warper.apply(output_image.unsqueeze(0) + 1.0, self.output_matrix,
+                                             args.output_w, args.output_h)[0] - 1.0
+        return postprocess_output_image(output_image, out)
+
+    def flush_downloads(self, model_cache):
+        # 实时帧已经直接下载进共享内存的槽位并发布，这里只写缓存；
+        # 槽位之后会被复用，留在内存缓存里的需要拷贝一份
+        for key, postprocessed_image in self.downloader.collect():
+            if self.disk_cache is not None:
+                self.disk_cache.put(key.tobytes(), postprocessed_image)
+            if model_cache.max_bytes > 0:
+                model_cache.put(key, postprocessed_image.copy())
+
+    def render_batch(self, model, input_image, batch, model_cache, dtype):
+        # 把提前排好的若干帧一次性送进模型，结果带上slot放回输出队列
+        self.flush_downloads(model_cache)
+        frames = [None] * len(batch['slots'])
+        miss = OrderedDict()
+        for i, model_input in enumerate(batch['model_inputs']):
+            model_input, key = self.simplify_model_input(model_input)
+            key_bytes = key.tobytes()
+            cached = model_cache.get(key)
+            if cached is None and self.disk_cache is not None:
+                cached = self.disk_cache.get(key_bytes)
+                if cached is not None:
+                    model_cache.put(key, cached)
+            if cached is not None:
+                frames[i] = cached
+            elif key_bytes in miss:
+                miss[key_bytes][2].append(i)
+            else:
+                miss[key_bytes] = (model_input, key, [i])
+        if len(miss) > 0:
+            vectors = torch.from_numpy(np.stack([v[0] for v in miss.values()])).to(self.device, dtype=dtype)
+            output_images = model.forward_batch(input_image, vectors[:, 12:12 + 27], vectors[:, 12 + 27:],
+                                                vectors[:, 0:12])
+            for j in range(len(miss)):
+                self.downloader.submit(self.postprocess(output_images[j]))
+            downloaded = self.downloader.collect()
+            for (_, postprocessed_image), (key_bytes, (model_input, key, indices)) in zip(downloaded, miss.items()):
+                for i in indices:
+                    frames[i] = postprocessed_image
+                if self.disk_cache is not None:
+                    self.disk_cache.put(key_bytes, postprocessed_image)
+                model_cache.put(key, postprocessed_image)
+        for slot, frame in zip(batch['slots'], frames):
+            self.output_queue.put((batch['generation'], slot, frame))
 
+    @torch.no_grad()
     def run(self):
-        model = TalkingAnime3().to(self.device)
+        model = TalkingAnime3(self.device).to(self.device)
         model = model.eval()
         print("Pretrained Model Loaded")
 
-        eyebrow_vector = torch.empty(1, 12, dtype=torch.half if args.model.endswith('half') else torch.float)
-        mouth_eye_vector = torch.empty(1, 27, dtype=torch.half if args.model.endswith('half') else torch.float)
-        pose_vector = torch.empty(1, 6, dtype=torch.half if args.model.endswith('half') else torch.float)
-
+        dtype = torch.half if args.half else torch.float
+        self.downloader = FrameDownloader(self.device, ring=self.frame_ring)
+        if args.gpu_warp:
+            # 角色位置目前是固定的，变换矩阵整个运行期间不变
+            self.warper = AffineWarper()
+            self.output_matrix = output_matrix()
+
+        if args.disk_cache is not None:
+            variant = args.model + ('_eyebrow' if args.eyebrow else '') + f'_s{args.simplify}'  # key是量化步数，和simplify档位绑定
+            if args.render_scale != 1:
+                variant += f'_r{int(512 * args.render_scale)}'
+            if args.roi:
+                variant += '_roi'  # --roi的帧是近似结果，不能和整帧渲染的结果混用
+            if args.gpu_warp:
+                variant += f'_{args.output_w}x{args.output_h}' + ('_bongo' if args.bongo else '')
+            self.disk_cache = DiskFrameCache(args.disk_cache, variant, self.frame_ring.frame_shape,
+                                             convert_to_byte(args.disk_cache_size))
+            self.disk_cache.open(image_hash(self.input_image))
         input_image = self.input_image.to(self.device)
-        eyebrow_vector = eyebrow_vector.to(self.device)
-        mouth_eye_vector = mouth_eye_vector.to(self.device)
-        pose_vector = pose_vector.to(self.device)
+        model.prepare_image(input_image)
 
-        model_cache = OrderedDict()
+        model_cache = FrameCache(args.max_cache_bytes, args.cache_tolerance, args.cache_policy)
+        pending_batches = []
+        live_input = None
         tot = 0
         hit = 0
         hit_in_a_row = 0
@@ -92,177 +288,103 @@ class ModelClientProcess(Process):
         gpu_fps = FPS()
         cur_sec = int(time.perf_counter())
         fps_num = 0
-        while True:
-            # time.sleep(fps_delay)
+        while not self.should_terminate.value:
             if int(time.perf_counter()) == cur_sec:
                 fps_num += 1
             else:
                 # print(fps_num)
                 fps_num = 0
                 cur_sec = int(time.perf_counter())
+                if args.debug and cur_sec % 10 == 0:
+                    print("cache", model_cache.stats(), "gpu cache", model.face_cache.stats())
 
             if not self.input_image_q.empty():
-                input_image = self.input_image_q.get_nowait().to(self.device)
-                model.face_cache = OrderedDict()
-                model_cache = OrderedDict()
+                input_image = self.input_image_q.get_nowait()
+                self.flush_downloads(model_cache)
+                if self.disk_cache is not None:
+                    self.disk_cache.open(image_hash(input_image))
+                input_image = input_image.to(self.device)
+                model.prepare_image(input_image)
+                model_cache.clear()
+                pending_batches = []
+                live_input = None
 
-            model_input = None
             try:
-                while not self.input_queue.empty():
-                    model_input = self.input_queue.get_nowait()
+                # 什么都没有待渲染时阻塞等待，超时只是为了能检查换图和退出信号
+                if len(pending_batches) == 0 and live_input is None:
+                    item = self.input_queue.get(timeout=0.1)
+                else:
+                    item = self.input_queue.get_nowait()
+                while True:
+                    if isinstance(item, dict):  # 预渲染的批量输入，不能像实时输入一样丢弃
+                        pending_batches.append(item)
+                    else:  # 实时输入只保留最新的一个
+                        live_input = item
+                    item = self.input_queue.get_nowait()
             except queue.Empty:
+                pass
+            if len(pending_batches) > 0:
+                # 批量输入先于实时输入渲染：这些slot到期时主进程不会再发实时输入，
+                # 否则渲染慢于--fps时实时输入一直在排队，批量输入永远轮不到
+                self.flush_downloads(model_cache)
+                # 时间线已经重置过的批量输入直接丢弃
+                latest_generation = pending_batches[-1]['generation']
+                pending_batches = [b for b in pending_batches if b['generation'] == latest_generation]
+                self.render_batch(model, input_image, pending_batches.pop(0), model_cache, dtype)
+                # 排在批量输入前面的实时输入已经过时，主进程在未覆盖的slot会重新发送
+                live_input = None
                 continue
-            if model_input is None:
+            if live_input is None:
+                self.flush_downloads(model_cache)
                 continue
-            simplify_arr = [1000] * ifm_converter.pose_size
-            if args.simplify >= 1:
-                simplify_arr = [200] * ifm_converter.pose_size
-                simplify_arr[ifm_converter.eye_wink_left_index] = 50
-                simplify_arr[ifm_converter.eye_wink_right_index] = 50
-                simplify_arr[ifm_converter.eye_happy_wink_left_index] = 50
-                simplify_arr[ifm_converter.eye_happy_wink_right_index] = 50
-                simplify_arr[ifm_converter.eye_surprised_left_index] = 30
-                simplify_arr[ifm_converter.eye_surprised_right_index] = 30
-                simplify_arr[ifm_converter.iris_rotation_x_index] = 25
-                simplify_arr[ifm_converter.iris_rotation_y_index] = 25
-                simplify_arr[ifm_converter.eye_raised_lower_eyelid_left_index] = 10
-                simplify_arr[ifm_converter.eye_raised_lower_eyelid_right_index] = 10
-                simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 5
-                simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 5
-                simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 5
-                simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 5
-            if args.simplify >= 2:
-                simplify_arr[ifm_converter.head_x_index] = 100
-                simplify_arr[ifm_converter.head_y_index] = 100
-                simplify_arr[ifm_converter.eye_surprised_left_index] = 10
-                simplify_arr[ifm_converter.eye_surprised_right_index] = 10
-                model_input[ifm_converter.eye_wink_left_index] += model_input[
-                    ifm_converter.eye_happy_wink_left_index]
-                model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
-                                                                           ifm_converter.eye_wink_left_index] / 2
-                model_input[ifm_converter.eye_wink_left_index] = model_input[
-                                                                     ifm_converter.eye_wink_left_index] / 2
-                model_input[ifm_converter.eye_wink_right_index] += model_input[
-                    ifm_converter.eye_happy_wink_right_index]
-                model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
-                                                                            ifm_converter.eye_wink_right_index] / 2
-                model_input[ifm_converter.eye_wink_right_index] = model_input[
-                                                                      ifm_converter.eye_wink_right_index] / 2
-
-                uosum = model_input[ifm_converter.mouth_uuu_index] + \
-                        model_input[ifm_converter.mouth_ooo_index]
-                model_input[ifm_converter.mouth_ooo_index] = uosum
-                model_input[ifm_converter.mouth_uuu_index] = 0
-                is_open = (model_input[ifm_converter.mouth_aaa_index] + model_input[
-                    ifm_converter.mouth_iii_index] + uosum) > 0
-                model_input[ifm_converter.mouth_lowered_corner_left_index] = 0
-                model_input[ifm_converter.mouth_lowered_corner_right_index] = 0
-                model_input[ifm_converter.mouth_raised_corner_left_index] = 0.5 if is_open else 0
-                model_input[ifm_converter.mouth_raised_corner_right_index] = 0.5 if is_open else 0
-                simplify_arr[ifm_converter.mouth_lowered_corner_left_index] = 0
-                simplify_arr[ifm_converter.mouth_lowered_corner_right_index] = 0
-                simplify_arr[ifm_converter.mouth_raised_corner_left_index] = 0
-                simplify_arr[ifm_converter.mouth_raised_corner_right_index] = 0
-            if args.simplify >= 3:
-                simplify_arr[ifm_converter.iris_rotation_x_index] = 20
-                simplify_arr[ifm_converter.iris_rotation_y_index] = 20
-                simplify_arr[ifm_converter.eye_wink_left_index] = 32
-                simplify_arr[ifm_converter.eye_wink_right_index] = 32
-                simplify_arr[ifm_converter.eye_happy_wink_left_index] = 32
-                simplify_arr[ifm_converter.eye_happy_wink_right_index] = 32
-            if args.simplify >= 4:
-                simplify_arr[ifm_converter.head_x_index] = 50
-                simplify_arr[ifm_converter.head_y_index] = 50
-                simplify_arr[ifm_converter.neck_z_index] = 100
-                model_input[ifm_converter.eye_raised_lower_eyelid_left_index] = 0
-                model_input[ifm_converter.eye_raised_lower_eyelid_right_index] = 0
-                simplify_arr[ifm_converter.iris_rotation_x_index] = 10
-                simplify_arr[ifm_converter.iris_rotation_y_index] = 10
-                simplify_arr[ifm_converter.eye_wink_left_index] = 24
-                simplify_arr[ifm_converter.eye_wink_right_index] = 24
-                simplify_arr[ifm_converter.eye_happy_wink_left_index] = 24
-                simplify_arr[ifm_converter.eye_happy_wink_right_index] = 24
-                simplify_arr[ifm_converter.eye_surprised_left_index] = 8
-                simplify_arr[ifm_converter.eye_surprised_right_index] = 8
-                model_input[ifm_converter.eye_wink_left_index] += model_input[
-                    ifm_converter.eye_wink_right_index]
-                model_input[ifm_converter.eye_wink_right_index] = model_input[
-                                                                      ifm_converter.eye_wink_left_index] / 2
-                model_input[ifm_converter.eye_wink_left_index] = model_input[
-                                                                     ifm_converter.eye_wink_left_index] / 2
-
-                model_input[ifm_converter.eye_surprised_left_index] += model_input[
-                    ifm_converter.eye_surprised_right_index]
-                model_input[ifm_converter.eye_surprised_right_index] = model_input[
-                                                                           ifm_converter.eye_surprised_left_index] / 2
-                model_input[ifm_converter.eye_surprised_left_index] = model_input[
-                                                                          ifm_converter.eye_surprised_left_index] / 2
-
-                model_input[ifm_converter.eye_happy_wink_left_index] += model_input[
-                    ifm_converter.eye_happy_wink_right_index]
-                model_input[ifm_converter.eye_happy_wink_right_index] = model_input[
-                                                                            ifm_converter.eye_happy_wink_left_index] / 2
-                model_input[ifm_converter.eye_happy_wink_left_index] = model_input[
-                                                                           ifm_converter.eye_happy_wink_left_index] / 2
-                model_input[ifm_converter.mouth_aaa_index] = min(
-                    model_input[ifm_converter.mouth_aaa_index] +
-                    model_input[ifm_converter.mouth_ooo_index] / 2 +
-                    model_input[ifm_converter.mouth_iii_index] / 2 +
-                    model_input[ifm_converter.mouth_uuu_index] / 2, 1
-                )
-                model_input[ifm_converter.mouth_ooo_index] = 0
-                model_input[ifm_converter.mouth_iii_index] = 0
-                model_input[ifm_converter.mouth_uuu_index] = 0
-            for i in range(4, args.simplify):
-                simplify_arr = [max(math.ceil(x * 0.8), 5) for x in simplify_arr]
-            for i in range(0, len(simplify_arr)):
-                if simplify_arr[i] > 0:
-                    model_input[i] = round(model_input[i] * simplify_arr[i]) / simplify_arr[i]
-            input_hash = hash(tuple(model_input))
-            cached = model_cache.get(input_hash)
+            model_input = live_input
+            live_input = None
+            model_input, key = self.simplify_model_input(model_input)
+            # 连续命中超过一秒的帧数就强制渲染一帧；用不上的命中不必去读磁盘缓存
+            cached = None
+            if hit_in_a_row < self.model_fps_number.value:
+                cached = model_cache.get(key)
+                if cached is None and self.disk_cache is not None:
+                    cached = self.disk_cache.get(key.tobytes())
+                    if cached is not None:
+                        model_cache.put(key, cached)
             tot += 1
-            eyebrow_vector_c = [0.0] * 12
-            mouth_eye_vector_c = [0.0] * 27
-            if cached is not None and hit_in_a_row < self.model_fps_number.value:
-                self.output_queue.put(cached)
-                model_cache.move_to_end(input_hash)
+            if cached is not None:
+                self.flush_downloads(model_cache)
+                self.frame_ring.write(cached)
                 hit += 1
                 hit_in_a_row += 1
             else:
                 hit_in_a_row = 0
-                if args.eyebrow:
-                    for i in range(12):
-                        eyebrow_vector[0, i] = model_input[i]
-                        eyebrow_vector_c[i] = model_input[i]
-                for i in range(27):
-                    mouth_eye_vector[0, i] = model_input[i + 12]
-                    mouth_eye_vector_c[i] = model_input[i + 12]
-                for i in range(6):
-                    pose_vector[0, i] = model_input[i + 27 + 12]
-
-                output_image = model(input_image, mouth_eye_vector, pose_vector, eyebrow_vector, mouth_eye_vector_c,
-                                     eyebrow_vector_c,
+                # 45个参数一次拷贝到显存，再按切片分给各个子模型
+                vectors = torch.from_numpy(model_input).to(self.device, dtype=dtype).unsqueeze(0)
+                eyebrow_vector = vectors[:, 0:12]
+                mouth_eye_vector = vectors[:, 12:12 + 27]
+                pose_vector = vectors[:, 12 + 27:]
+
+                face_key = key[0:12 + 27] if args.eyebrow else key[12:12 + 27]
+                output_image = model(input_image, mouth_eye_vector, pose_vector, eyebrow_vector, face_key,
                                      self.gpu_cache_hit_ratio)
 
-                postprocessed_image = output_image[0].float()
-                postprocessed_image = convert_linear_to_srgb((postprocessed_image + 1.0) / 2.0)
-                c, h, w = postprocessed_image.shape
-                postprocessed_image = 255.0 * torch.transpose(postprocessed_image.reshape(c, h * w), 0, 1).reshape(h, w,
-                                                                                                                   c)
-                postprocessed_image = postprocessed_image.byte().detach().cpu().numpy()
-
-                self.output_queue.put(postprocessed_image)
+                # 这一帧的推理已经排进GPU队列，此时再取上一帧，上一帧的下载和这一帧的推理重叠
+                self.flush_downloads(model_cache)
+                self.downloader.submit_to_ring(lambda out=None: self.postprocess(output_image[0], out), key)
+                if self.input_queue.empty():  # 后面没有排队的输入就不再等下一帧，直接输出
+                    self.flush_downloads(model_cache)
                 if args.debug:
                     self.gpu_fps_number.value = gpu_fps()
-                if args.max_cache_len > 0:
-                    model_cache[input_hash] = postprocessed_image
-                    if len(model_cache) > args.max_cache_len:
-                        model_cache.popitem(last=False)
+            # 命中上限依赖模型帧率，不管是否--debug都要更新
+            self.model_fps_number.value = model_fps()
             if args.debug:
-                self.model_fps_number.value = model_fps()
                 self.cache_hit_ratio.value = hit / tot
             # print('model_fps:' + str(self.model_fps_number.value))
             # print('gpu_fps:' + str(self.gpu_fps_number.value))
+        self.flush_downloads(model_cache)
+        # 先取消共享内存的锁页注册，再关闭这个进程里的映射
+        self.downloader.close()
+        self.frame_ring.close()
+        if self.disk_cache is not None:
+            self.disk_cache.close()
 
 
 def prepare_input_img(IMG_WIDTH, charc):
@@ -279,7 +401,7 @@ def prepare_input_img(IMG_WIDTH, charc):
             x = i % IMG_WIDTH
             img.putpixel((x, y), (0, 0, 0, 0))
     input_image = preprocessing_image(img.crop((0, 0, IMG_WIDTH, IMG_WIDTH)))
-    if args.model.endswith('half'):
+    if args.half:
         input_image = torch.from_numpy(input_image).half() * 2.0 - 1
     else:
         input_image = torch.from_numpy(input_image).float() * 2.0 - 1
@@ -298,6 +420,7 @@ class EasyAIV(Process):  #
 
         self.model_process_input_queue = model_process_args['input_queue']
         self.model_process_output_queue = model_process_args['output_queue']
+        self.frame_ring = model_process_args['frame_ring']
 
         self.alive_args_is_speech = alive_args['is_speech']
         self.alive_args_speech_q = alive_args['speech_q']
@@ -321,11 +444,17 @@ class EasyAIV(Process):  #
         mouth_q = None
         beat_q = None
         action = ActionAnimeV2()
+        scheduler = LookAheadScheduler(args.fps, args.lookahead)
+        prerendered = PrerenderedFrames()
+        interpolator = FrameInterpolator(args.interpolate) if args.interpolate != 'none' else None
+        compositor = Compositor(args.output_w, args.output_h)
         idle_start_time = time.perf_counter()
+        next_frame_time = time.perf_counter()
         print("Ready. Close this console to exit.")
         while True:
             conn, address = self.server_socket.accept()
             print("来自" + str(address) + "的连接")
+            sink = SocketSink(conn)
             try:
                 while True:
                     # time.sleep(fps_delay)
@@ -358,58 +487,46 @@ class EasyAIV(Process):  #
                     if not idle_flag:
                         idle_start_time = time.perf_counter()
 
-                    pose_vector_c[3] = pose_vector_c[1]
-                    pose_vector_c[4] = pose_vector_c[2]
-
-                    model_input_arr = eyebrow_vector_c
-                    model_input_arr.extend(mouth_eye_vector_c)
-                    model_input_arr.extend(pose_vector_c)
-
-                    self.model_process_input_queue.put_nowait(model_input_arr)
+                    now = time.perf_counter()
+                    model_input_arr = build_model_input(eyebrow_vector_c, mouth_eye_vector_c, pose_vector_c)
+                    lookahead_batch = scheduler.schedule(action, now)
+                    if lookahead_batch is not None:
+                        self.model_process_input_queue.put_nowait(lookahead_batch)
 
-                    has_model_output = 0
                     try:
-                        new_model_output = model_output
+                        # 输出队列只剩预渲染的帧 (generation, slot, frame)
                         while not self.model_process_output_queue.empty():
-                            has_model_output += 1
-                            new_model_output = self.model_process_output_queue.get_nowait()
-                        model_output = new_model_output
+                            prerendered.add(*self.model_process_output_queue.get_nowait())
                     except queue.Empty:
                         pass
+                    # 实时帧直接从共享内存读取最新的一帧，不拷贝
+                    latest_frame = self.frame_ring.read_latest()
+                    if latest_frame is not None:
+                        model_output = latest_frame
+                    prerendered_frame = prerendered.pop(action.timeline_generation, scheduler.slot(now))
+                    if prerendered_frame is not None:
+                        model_output = prerendered_frame
+                    elif not scheduler.covers(action.timeline_generation, scheduler.slot(now)):
+                        self.model_process_input_queue.put_nowait(model_input_arr)
+                    if interpolator is not None:
+                        # 模型帧之间按输出帧率补帧
+                        if latest_frame is not None or prerendered_frame is not None:
+                            interpolator.push(model_output, now)
+                        model_output = interpolator.frame(now)
                     if model_output is None:
                         time.sleep(1)
                         continue
                     postprocessed_image = model_output
-                    k_scale = 1
-                    rotate_angle = 0
-                    dx = 0
-                    dy = 0
-                    if args.extend_movement:
-                        k_scale = position_vector[2] * math.sqrt(args.extend_movement) + 1
-                        rotate_angle = -position_vector[0] * 10 * args.extend_movement
-                        dx = position_vector[0] * 400 * k_scale * args.extend_movement
-                        dy = -position_vector[1] * 600 * k_scale * args.extend_movement
-                    if args.bongo:
-                        rotate_angle -= 5
-                    rm = cv2.getRotationMatrix2D((IMG_WIDTH / 2, IMG_WIDTH / 2), rotate_angle, k_scale)
-                    rm[0, 2] += dx + args.output_w / 2 - IMG_WIDTH / 2
-                    rm[1, 2] += dy + args.output_h / 2 - IMG_WIDTH / 2
-
-                    postprocessed_image = cv2.warpAffine(
-                        postprocessed_image,
-                        rm,
-                        (args.output_w, args.output_h))
+                    if not args.gpu_warp:  # --gpu_warp时模型进程已经输出了--output_size的画面
+                        rm = output_matrix(position_vector, IMG_WIDTH)
+                        # 没有旋转缩放时只做整数平移或直接输出，不再整帧重采样
+                        postprocessed_image = compositor.compose(postprocessed_image, rm)
 
                     if args.output_webcam:
-                        result_image = postprocessed_image
-                        _, buffer = cv2.imencode('.webp', result_image, [cv2.IMWRITE_WEBP_QUALITY, 95])
-                        # _, buffer = cv2.imencode('.png', result_image)
-                        data = buffer.tobytes()  # 转换为字节流
-
-                        # 先发送数据长度
-                        conn.sendall(len(data).to_bytes(4, 'big'))
-                        # 发送图像数据
-                        conn.sendall(data)
+                        sink.send(postprocessed_image)
+                    # 按输出帧率等待，避免空转
+                    next_frame_time = max(next_frame_time + 1 / args.fps, time.perf_counter())
+                    time.sleep(max(0.0, next_frame_time - time.perf_counter()))
                     # if args.output_webcam:
                     #     result_image = postprocessed_image
                     #     _, buffer = cv2.imencode('.png', result_image)
@@ -477,15 +594,19 @@ class FlaskAPI(Resource):
 if __name__ == '__main__':
     print('torch.cuda.is_available() ', torch.cuda.is_available())
     print('torch.cuda.device_count() ', torch.cuda.device_count())
-    print('torch.cuda.get_device_name(0) ', torch.cuda.get_device_name(0))
+    if torch.cuda.is_available():
+        print('torch.cuda.get_device_name(0) ', torch.cuda.get_device_name(0))
     device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    if args.backend == 'onnxruntime' or args.model.endswith('int8'):
+        device = torch.device('cpu')
 
     input_image, extra_image = prepare_input_img(512, args.character)
     multiprocessing.set_start_method('spawn')
 
     # 声明跨进程公共参数
     model_process_args = {
-        "output_queue": Queue(maxsize=3),
+        "output_queue": Queue(maxsize=3 + args.lookahead),
+        "frame_ring": FrameRing((args.output_h, args.output_w, 4) if args.gpu_warp else (512, 512, 4)),
         "input_queue": Queue(),
         "input_image_q": Queue()
     }
@@ -514,4 +635,7 @@ if __name__ == '__main__':
 
     api.add_resource(FlaskAPI, '/alive')
     app.run(host='0.0.0.0', port=args.port)  # 运行 Flask app
+    model_process.should_terminate.value = True
+    model_process.join(timeout=5)
+    model_process_args['frame_ring'].close()
     print('process done')
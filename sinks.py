@@ -0,0 +1,217 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import cv2
+
+from args import args
+
+
+class FrameSink(ABC):
+    """
+    Destination of the final RGBA frames.
+    `paced`: sync() itself waits for the next frame time (virtual camera).
+    `realtime`: frames are consumed live; offline sinks get exactly one rendered frame per
+    1/fps step of a FrameClock and the frame loop runs as fast as the model.
+    """
+    paced = False
+    realtime = True
+
+    @abstractmethod
+    def send(self, frame):
+        pass
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class VirtualCamSink(FrameSink):
+    paced = True
+
+    def __init__(self, width, height, fps, backend):
+        import pyvirtualcam
+        self.backend = backend
+        self.cam = pyvirtualcam.Camera(width=width,
+                                       height=height,
+                                       fps=fps,
+                                       backend=backend,
+                                       fmt=
+                                       {'unitycapture': pyvirtualcam.PixelFormat.RGBA,
+                                        'obs': pyvirtualcam.PixelFormat.RGB}[
+                                           backend])
+        print(f'Using virtual camera: {self.cam.device}')
+
+    def send(self, frame):
+        if self.backend == 'obs':
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB)
+        self.cam.send(frame)
+
+    def sync(self):
+        self.cam.sleep_until_next_frame()
+
+    def close(self):
+        self.cam.close()
+
+
+class SocketSink(FrameSink):
+    # 每帧编码成webp，先发4字节长度再发数据
+
+    def __init__(self, conn, quality=95):
+        self.conn = conn
+        self.quality = quality
+
+    def send(self, frame):
+        _, buffer = cv2.imencode('.webp', frame, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+        data = buffer.tobytes()
+        self.conn.sendall(len(data).to_bytes(4, 'big'))
+        self.conn.sendall(data)
+
+
+class NullSink(FrameSink):
+    # 丢弃所有帧，只统计帧率，用来测试不受输出影响的渲染速度
+    realtime = False
+
+    def __init__(self):
+        self.frames = 0
+        self.start_time = None
+
+    def send(self, frame):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        self.frames += 1
+
+    def close(self):
+        if self.frames > 1:
+            print("null sink: %d frames, %.1f fps" % (
+                self.frames, (self.frames - 1) / (time.perf_counter() - self.start_time)))
+
+
+class ThreadedSink(FrameSink):
+    """
+    Hands frames to a writer thread through a bounded queue. When the writer falls behind,
+    offline sinks block the frame loop; realtime ones drop (and count) new frames instead.
+    """
+    realtime = False
+
+    def __init__(self, max_pending=32):
+        self.frames = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, frame):
+        # 调用方会复用缓冲区，入队的是拷贝
+        if not self.realtime:
+            # 离线输出不能丢帧，写不过来时等待
+            self.frames.put(frame.copy())
+            return
+        try:
+            self.frames.put_nowait(frame.copy())
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            self.write(frame)
+        self.finish()
+
+    @abstractmethod
+    def write(self, frame):
+        pass
+
+    def finish(self):
+        pass
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        if self.dropped > 0:
+            print(f"{type(self).__name__}: dropped {self.dropped} frames, the writer could not keep up")
+
+
+class ImageSequenceSink(ThreadedSink):
+    # 按序号把每帧存成带透明通道的png
+
+    def __init__(self, output_dir, max_pending=32):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.index = 0
+        super().__init__(max_pending)
+
+    def write(self, frame):
+        cv2.imwrite(os.path.join(self.output_dir, '%06d.png' % self.index), cv2.cvtColor(frame, cv2.COLOR_RGBA2BGRA))
+        self.index += 1
+
+
+class FFmpegSink(ThreadedSink):
+    """
+    Pipes raw RGBA frames into ffmpeg. The default output is lossless FFV1 with alpha in
+    Matroska, which stays readable even if the process is killed mid-stream.
+    """
+
+    def __init__(self, path, width, height, fps, max_pending=32):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-y', '-loglevel', 'error',
+             '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+             '-c:v', 'ffv1', '-pix_fmt', 'bgra', path],
+            stdin=subprocess.PIPE)
+        super().__init__(max_pending)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def finish(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class FrameClock:
+    """
+    Time source of the frame loop. Realtime sinks follow time.perf_counter(); for offline
+    sinks the clock starts at the current time and only advances 1/fps per tick(), so file
+    output plays at --fps however fast or slow the model renders.
+    """
+
+    def __init__(self, fps, realtime):
+        self.fps = fps
+        self.realtime = realtime
+        # 起点对齐到帧格子的中间，每次tick正好前进一个slot
+        self.start = (int(time.perf_counter() * fps) + 0.5) / fps
+        self.frames = 0
+
+    def __call__(self):
+        if self.realtime:
+            return time.perf_counter()
+        return self.start + self.frames / self.fps
+
+    def tick(self):
+        self.frames += 1
+
+
+def create_sink(width, height):
+    """
+    Sink selected by --sink for frames of width x height. Without --sink, the virtual camera
+    is used when --output_webcam is set, else the image sequence when --output_dir is set.
+    """
+    sink = args.sink
+    if sink is None:
+        sink = 'cam' if args.output_webcam else 'images' if args.output_dir else 'null'
+    if sink in ('images', 'ffmpeg') and args.output_dir is None:
+        raise RuntimeError(f"--sink {sink} needs --output_dir")
+    if sink == 'cam':
+        return VirtualCamSink(width, height, args.fps, args.output_webcam)
+    if sink == 'images':
+        return ImageSequenceSink(args.output_dir)
+    if sink == 'ffmpeg':
+        return FFmpegSink(os.path.join(args.output_dir, 'output.mkv'), width, height, args.fps)
+    return NullSink()
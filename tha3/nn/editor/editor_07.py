@@ -88,7 +88,8 @@ class Editor07(Module):
                 pose: Tensor,
                 *args) -> List[Tensor]:
         n, c = pose.shape
-        pose = pose.view(n, c, 1, 1).repeat(1, 1, self.args.image_size, self.args.image_size)
+        # 按输入尺寸展开姿势，便于以低于训练分辨率的尺寸运行
+        pose = pose.view(n, c, 1, 1).repeat(1, 1, input_original_image.shape[2], input_original_image.shape[3])
         feature = torch.cat([input_original_image, input_warped_image, input_grid_change, pose], dim=1)
 
         feature = self.body.forward(feature)[-1]
@@ -54,5 +54,46 @@ class GridChangeApplier:
         return resampled_image
 
 
+class AffineWarper:
+    """
+    GPU equivalent of cv2.warpAffine with a constant border of zero. Sampling always runs in
+    float32 and the result is cast back to the input dtype. The sampling grid is cached and
+    only rebuilt when the matrix, sizes or device change.
+    """
+
+    def __init__(self):
+        self.last_key = None
+        self.last_grid = None
+
+    def apply(self, image: Tensor, matrix, output_width: int, output_height: int) -> Tensor:
+        """
+        Args:
+            image: [n, c, h, w]
+            matrix: 2x3 affine matrix in pixel coordinates from image to output, as used by cv2
+        """
+        n, c, h, w = image.shape
+        matrix = [[float(v) for v in row] for row in matrix]
+        key = (str(matrix), n, h, w, output_width, output_height, image.device)
+        if key == self.last_key:
+            grid = self.last_grid
+        else:
+            forward = torch.tensor(matrix + [[0.0, 0.0, 1.0]], dtype=torch.float64)
+            # 输出的归一化坐标 -> 输出像素 -> 输入像素 -> 输入的归一化坐标（align_corners=False）
+            output_to_pixel = torch.tensor([[output_width / 2, 0.0, (output_width - 1) / 2],
+                                            [0.0, output_height / 2, (output_height - 1) / 2],
+                                            [0.0, 0.0, 1.0]], dtype=torch.float64)
+            pixel_to_input = torch.tensor([[2 / w, 0.0, 1 / w - 1],
+                                           [0.0, 2 / h, 1 / h - 1],
+                                           [0.0, 0.0, 1.0]], dtype=torch.float64)
+            theta = (pixel_to_input @ torch.linalg.inv(forward) @ output_to_pixel)[0:2]
+            # 网格固定用float32，half的精度在1080p以上会丢掉亚像素位置，画面抖动
+            theta = theta.to(device=image.device, dtype=torch.float32).unsqueeze(0).repeat(n, 1, 1)
+            grid = affine_grid(theta, [n, c, output_height, output_width], align_corners=False)
+            self.last_key = key
+            self.last_grid = grid
+        output = grid_sample(image.float(), grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        return output.to(image.dtype)
+
+
 def apply_color_change(alpha, color_change, image: Tensor) -> Tensor:
     return color_change * alpha + image * (1 - alpha)
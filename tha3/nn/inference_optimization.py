@@ -0,0 +1,54 @@
+import torch
+from torch.nn import Module, Conv2d, BatchNorm2d, Identity, Parameter
+from torch.nn.utils import remove_spectral_norm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from tha3.nn.normalization import Bias2d
+
+
+def remove_spectral_norms(module: Module):
+    for child in module.modules():
+        if hasattr(child, 'weight_orig'):
+            remove_spectral_norm(child)
+
+
+def fold_affine_norms(module: Module):
+    # Fold a BatchNorm2d (eval statistics) or Bias2d that directly follows a Conv2d inside the
+    # same container into the conv. InstanceNorm2d depends on per-image statistics and cannot
+    # be folded, so blocks using it are left alone.
+    children = list(module.named_children())
+    for (_, previous), (name, child) in zip(children, children[1:]):
+        if not isinstance(previous, Conv2d):
+            continue
+        if isinstance(child, BatchNorm2d) and child.track_running_stats:
+            fused = fuse_conv_bn_eval(previous.eval(), child.eval())
+            previous.weight = fused.weight
+            previous.bias = fused.bias
+            setattr(module, name, Identity())
+        elif isinstance(child, Bias2d):
+            bias = child.bias.detach().view(-1)
+            if previous.bias is None:
+                previous.bias = Parameter(bias.clone())
+            else:
+                previous.bias = Parameter(previous.bias.detach() + bias)
+            setattr(module, name, Identity())
+    for _, child in module.named_children():
+        fold_affine_norms(child)
+
+
+def optimize_for_inference(module: Module) -> Module:
+    """
+    Load-time inference pass: removes spectral-norm reparametrization, folds affine norms into
+    the preceding convolution where that is exact, and switches the weights to channels_last.
+    """
+    module = module.eval()
+    remove_spectral_norms(module)
+    fold_affine_norms(module)
+    return module.to(memory_format=torch.channels_last)
+
+
+@torch.no_grad()
+def max_output_difference(module: Module, optimized: Module, inputs) -> float:
+    expected = module(*inputs)
+    actual = optimized(*inputs)
+    return max((e.float() - a.float()).abs().max().item() for e, a in zip(expected, actual))
@@ -0,0 +1,40 @@
+import warnings
+
+import torch
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+from torch.nn import Conv2d, Module, Sequential
+
+
+def wrap_conv2d_for_int8(module: Module, prefix: str = ''):
+    # Each Conv2d is quantized on its own: quantize -> int8 conv -> dequantize. Everything in
+    # between (instance norm, nonlinearities, grid_sample) stays in float. Convs producing grid
+    # changes are kept in float because sub-pixel offsets do not survive int8.
+    for name, child in module.named_children():
+        full_name = prefix + name
+        if isinstance(child, Conv2d):
+            if 'grid_change' not in full_name:
+                wrapper = Sequential(QuantStub(), child, DeQuantStub())
+                wrapper.qconfig = get_default_qconfig(torch.backends.quantized.engine)
+                setattr(module, name, wrapper)
+        else:
+            wrap_conv2d_for_int8(child, full_name + '.')
+
+
+def prepare_int8(module: Module) -> Module:
+    module = module.float().eval()
+    wrap_conv2d_for_int8(module)
+    return prepare(module, inplace=True)
+
+
+def convert_int8(module: Module) -> Module:
+    return convert(module, inplace=True)
+
+
+def load_int8(float_module: Module, file_name: str) -> Module:
+    module = prepare_int8(float_module)
+    with warnings.catch_warnings():
+        # observers are empty here; scales and zero points come from the state dict
+        warnings.simplefilter('ignore')
+        convert_int8(module)
+    module.load_state_dict(torch.load(file_name, map_location='cpu'))
+    return module
@@ -76,7 +76,8 @@ class TwoAlgoFaceBodyRotator05(Module):
 
     def forward(self, image: Tensor, pose: Tensor, *args) -> List[Tensor]:
         n, c = pose.shape
-        pose = pose.view(n, c, 1, 1).repeat(1, 1, self.args.image_size, self.args.image_size)
+        # 按输入尺寸展开姿势，便于以低于训练分辨率的尺寸运行
+        pose = pose.view(n, c, 1, 1).repeat(1, 1, image.shape[2], image.shape[3])
         feature = torch.cat([image, pose], dim=1)
 
         feature = self.encoder_decoder.forward(feature)[-1]
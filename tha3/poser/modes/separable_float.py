@@ -22,6 +22,7 @@ from tha3.compute.cached_computation_func import TensorListCachedComputationFunc
 from tha3.compute.cached_computation_protocol import CachedComputationProtocol
 from tha3.nn.nonlinearity_factory import ReLUFactory, LeakyReLUFactory
 from tha3.nn.normalization import InstanceNorm2dFactory
+from tha3.nn.inference_optimization import optimize_for_inference
 from tha3.nn.util import BlockArgs
 
 
@@ -144,7 +145,7 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
             raise RuntimeError("Unsupported key: " + key)
 
 
-def load_eyebrow_decomposer(file_name: str):
+def load_eyebrow_decomposer(file_name: str, optimize: bool = False):
     factory = EyebrowDecomposer03Factory(
         EyebrowDecomposer03Args(
             image_size=128,
@@ -162,10 +163,12 @@ def load_eyebrow_decomposer(file_name: str):
     module = factory.create()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_eyebrow_morphing_combiner(file_name: str):
+def load_eyebrow_morphing_combiner(file_name: str, optimize: bool = False):
     factory = EyebrowMorphingCombiner03Factory(
         EyebrowMorphingCombiner03Args(
             image_size=128,
@@ -184,10 +187,12 @@ def load_eyebrow_morphing_combiner(file_name: str):
     module = factory.create()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_face_morpher(file_name: str):
+def load_face_morpher(file_name: str, optimize: bool = False):
     factory = FaceMorpher09Factory(
         FaceMorpher09Args(
             image_size=192,
@@ -206,10 +211,12 @@ def load_face_morpher(file_name: str):
     module = factory.create()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_two_algo_generator(file_name) -> Module:
+def load_two_algo_generator(file_name, optimize: bool = False) -> Module:
     module = TwoAlgoFaceBodyRotator05(
         TwoAlgoFaceBodyRotator05Args(
             image_size=256,
@@ -229,10 +236,12 @@ def load_two_algo_generator(file_name) -> Module:
     print("Loading the face-body rotator ... ", end="")
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_editor(file_name) -> Module:
+def load_editor(file_name, optimize: bool = False) -> Module:
     module = Editor07(
         Editor07Args(
             image_size=512,
@@ -252,6 +261,8 @@ def load_editor(file_name) -> Module:
     print("Loading the combiner ... ", end="")
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
@@ -21,6 +21,7 @@ from tha3.compute.cached_computation_func import TensorListCachedComputationFunc
 from tha3.compute.cached_computation_protocol import CachedComputationProtocol
 from tha3.nn.nonlinearity_factory import ReLUFactory, LeakyReLUFactory
 from tha3.nn.normalization import InstanceNorm2dFactory
+from tha3.nn.inference_optimization import optimize_for_inference
 from tha3.nn.util import BlockArgs
 
 
@@ -142,7 +143,7 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
             raise RuntimeError("Unsupported key: " + key)
 
 
-def load_eyebrow_decomposer(file_name: str):
+def load_eyebrow_decomposer(file_name: str, optimize: bool = False):
     factory = EyebrowDecomposer00Factory(
         EyebrowDecomposer00Args(
             image_size=128,
@@ -160,10 +161,12 @@ def load_eyebrow_decomposer(file_name: str):
     module = factory.create().half()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_eyebrow_morphing_combiner(file_name: str):
+def load_eyebrow_morphing_combiner(file_name: str, optimize: bool = False):
     factory = EyebrowMorphingCombiner00Factory(
         EyebrowMorphingCombiner00Args(
             image_size=128,
@@ -182,10 +185,12 @@ def load_eyebrow_morphing_combiner(file_name: str):
     module = factory.create().half()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_face_morpher(file_name: str):
+def load_face_morpher(file_name: str, optimize: bool = False):
     factory = FaceMorpher08Factory(
         FaceMorpher08Args(
             image_size=192,
@@ -204,10 +209,12 @@ def load_face_morpher(file_name: str):
     module = factory.create().half()
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_two_algo_generator(file_name) -> Module:
+def load_two_algo_generator(file_name, optimize: bool = False) -> Module:
     module = TwoAlgoFaceBodyRotator05(
         TwoAlgoFaceBodyRotator05Args(
             image_size=256,
@@ -226,10 +233,12 @@ def load_two_algo_generator(file_name) -> Module:
     print("Loading the face-body rotator ... ", end="")
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
-def load_editor(file_name) -> Module:
+def load_editor(file_name, optimize: bool = False) -> Module:
     module = Editor07(
         Editor07Args(
             image_size=512,
@@ -248,6 +257,8 @@ def load_editor(file_name) -> Module:
     print("Loading the combiner ... ", end="")
     module.load_state_dict(torch_load(file_name))
     print("DONE!!!")
+    if optimize:
+        module = optimize_for_inference(module)
     return module
 
 
@@ -0,0 +1,33 @@
+"""
+Post-training int8 version of standard_float for CPU inference. Conv2d layers use calibrated static
+int8 quantization (see tha3.nn.quantization); weights are produced by `python benchmark.py int8`.
+The float weights are still needed to build the modules before the int8 state is loaded.
+"""
+from torch.nn import Module
+
+from tha3.nn.quantization import load_int8
+from tha3.poser.modes import standard_float
+
+
+def float_file_name(file_name: str) -> str:
+    return file_name.replace('standard_int8', 'standard_float')
+
+
+def load_eyebrow_decomposer(file_name: str, optimize: bool = False) -> Module:
+    return load_int8(standard_float.load_eyebrow_decomposer(float_file_name(file_name), optimize), file_name)
+
+
+def load_eyebrow_morphing_combiner(file_name: str, optimize: bool = False) -> Module:
+    return load_int8(standard_float.load_eyebrow_morphing_combiner(float_file_name(file_name), optimize), file_name)
+
+
+def load_face_morpher(file_name: str, optimize: bool = False) -> Module:
+    return load_int8(standard_float.load_face_morpher(float_file_name(file_name), optimize), file_name)
+
+
+def load_two_algo_generator(file_name: str, optimize: bool = False) -> Module:
+    return load_int8(standard_float.load_two_algo_generator(float_file_name(file_name), optimize), file_name)
+
+
+def load_editor(file_name: str, optimize: bool = False) -> Module:
+    return load_int8(standard_float.load_editor(float_file_name(file_name), optimize), file_name)
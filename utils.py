@@ -67,6 +67,48 @@ def postprocessing_image(tensor):
     return rgba_image.astype(np.uint8)
 
 
+_srgb_luts = {}
+
+
+def build_srgb_lut(size=4096):
+    """
+    build lookup table for linear_rgba2srgb_uint8
+    Args:
+        size (int): number of quantization levels of [0, 1]
+    Returns:
+        uint8 tensor of 2 * size entries: linear->srgb for rgb, then identity for alpha
+    """
+    x = torch.linspace(0.0, 1.0, size, dtype=torch.float64)
+    srgb = torch.where(x <= 0.003130804953560372, x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
+    return (torch.cat([srgb, x]) * 255.0).to(torch.uint8)
+
+
+def linear_rgba2srgb_uint8(tensor, lut_size=4096, out=None):
+    """
+    convert model output to a displayable frame in one table lookup
+    (clip, linear->srgb, alpha passthrough, CHW->HWC and *255 fused)
+    Args:
+        tensor: CHW rgba tensor in [-1, 1], linear color space
+        lut_size (int): number of quantization levels, 4096 keeps the error within 1/255
+        out: optional contiguous HWC uint8 tensor on the same device to write the frame into
+    Returns:
+        HWC uint8 rgba tensor on the same device, srgb color space
+    """
+    lut = _srgb_luts.get((tensor.device, lut_size))
+    if lut is None:
+        # 前三个通道查srgb表，alpha通道查后半张线性表
+        lut = (build_srgb_lut(lut_size).to(tensor.device),
+               torch.tensor([0, 0, 0, lut_size], dtype=torch.long, device=tensor.device))
+        _srgb_luts[(tensor.device, lut_size)] = lut
+    table, channel_offset = lut
+    index = tensor.permute(1, 2, 0).float().add(1.0).mul_(0.5 * (lut_size - 1)).round_()
+    index = index.clamp_(0, lut_size - 1).long().add_(channel_offset)
+    if out is not None:
+        torch.index_select(table, 0, index.reshape(-1), out=out.view(-1))
+        return out
+    return table[index]
+
+
 def get_distance(a, b):
     """
     calculate euclidean distance a to b